@@ -1,33 +1,34 @@
 import streamlit as st
-import base64
 import os
-import re
-from openai import OpenAI
-from PIL import Image
-from dotenv import load_dotenv
-import bcrypt
-from db_utils import add_question, add_user, get_user, add_feedback, add_message_to_question, count_user_messages
-from imagekitio import ImageKit
-from imagekitio.models.UploadFileRequestOptions import UploadFileRequestOptions
-from datetime import datetime
-
-# Load environment variables
-load_dotenv()
-
-openai_api_key = os.getenv("OPENAI_API_KEY")
-# imagekit_private_key = os.getenv("IMAGEKIT_PRIVATE_KEY")
-# imagekit_public_key = os.getenv("IMAGEKIT_PUBLIC_KEY")
-# imagekit_url_endpoint = os.getenv("IMAGEKIT_URL_ENDPOINT")
-
-# Create OpenAI client instance
-client = OpenAI(api_key=openai_api_key)
-
-# Initialize ImageKit with direct values
-imagekit = ImageKit(
-    private_key=os.getenv("IMAGEKIT_PRIVATE_KEY"),
-    public_key=os.getenv("IMAGEKIT_PUBLIC_KEY"),
-    url_endpoint=os.getenv("IMAGEKIT_URL_ENDPOINT")
+from db_utils import add_question, add_user, get_user, add_feedback, add_message_to_question, count_user_messages, set_password_hash
+from cache_utils import make_cache_key, get_cached_response, cache_response
+from latex_utils import format_latex_response, StreamingPreview
+from context_utils import build_context
+from image_utils import (
+    IMAGE_INLINE_UPLOAD, data_url, get_or_upload_image, image_sha256, preprocess_image,
+    preprocessing_report, save_image_question, start_upload, unprocessed_image, vision_detail
 )
+# Clients live in a process-wide registry so reruns reuse their connection pools
+from resources import get_imagekit
+from metrics_utils import metric_labels, timed
+from scheduler import SchedulerRejected
+from llm_utils import scheduled_completion, update_system_message
+from symbolic_utils import symbolic_response
+from similarity_utils import index_ready, similar_questions, warm_index
+from auth_utils import (
+    AuthBusy, check_password, end_session, hash_password, needs_rehash, restore_session, start_session
+)
+
+# Time the final formatting pass (wrapped here so streaming previews aren't counted)
+format_latex_response = timed("format_latex_response")(format_latex_response)
+
+# Build or load the similar-questions index off the script thread; a no-op after the first run
+warm_index()
+
+# Stream tokens to the page as they arrive instead of waiting for the full answer
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+# Turns rendered eagerly in the chat history; older ones load a page at a time
+HISTORY_PAGE_TURNS = int(os.getenv("HISTORY_PAGE_TURNS", "2"))
 
 # print("Private Key:", os.getenv('IMAGEKIT_PRIVATE_KEY'))
 # print("Public Key:", os.getenv('IMAGEKIT_PUBLIC_KEY'))
@@ -66,157 +67,152 @@ st.markdown("""
 #     return base64_string
 
 # Replace the encode_image_to_base64 function with this new function
-def upload_image_to_imagekit(image_file, subject):
+@timed("upload_image_to_imagekit", none_is_error=True)
+def upload_image_to_imagekit(image_bytes, file_name, subject):
     try:
-        # 1. First, let's see what we get from Streamlit
-        # st.write("Debug: Image file details from Streamlit:")
-        # st.write(f"File name: {image_file.name}")
-        # st.write(f"File type: {image_file.type}")
-        # st.write(f"File size: {image_file.size} bytes")
-
-        # 2. Convert Streamlit file to bytes and save temporarily
-        import tempfile
-        import os
-        
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-            # Write the Streamlit file content to temp file
-            tmp_file.write(image_file.getvalue())
-            tmp_file_path = tmp_file.name
-        
-        # 3. Upload using the temporary file
-        with open(tmp_file_path, 'rb') as file:
-            upload_response = imagekit.upload_file(
-                file=file,
-                file_name=image_file.name,
-                options=UploadFileRequestOptions(
-                    folder=f"/{subject.lower()}" if subject and subject != "None" else "/general",
-                    is_private_file=False,
-                    use_unique_file_name=True,
-                    response_fields=["is_private_file", "tags"],
-                    tags=[subject.lower() if subject and subject != "None" else "general"]
-                )
-            )
-        
-        # 4. Clean up the temporary file
-        os.unlink(tmp_file_path)
-        
-        # 5. Generate transformed URL
-        image_url = imagekit.url({
-            "path": upload_response.file_path,
-            "transformation": [{
-                "height": "300",
-                "width": "300"
-            }]
-        })
-        
-        # st.write("Debug: Generated URL:", image_url)
-        return image_url
+        # Content-addressed: identical bytes from any user reuse the stored URL
+        return get_or_upload_image(get_imagekit(), image_bytes, file_name, subject)
 
     except Exception as e:
         st.error(f"Error uploading image: {str(e)}")
         return None
     
 
-def get_response(messages):
+def wait_for_image_question():
+    """Wait for a background image question save, then swap the inline image
+    in the session thread for its ImageKit URL"""
+    pending = st.session_state.pop("pending_image_question", None)
+    if not pending:
+        return
+    saved, image_part = pending
+    image_url = saved.result()
+    if image_url:
+        image_part["image_url"]["url"] = image_url
+
+
+def _token_usage(response):
+    return response.get("token_usage")
+
+
+@timed("get_response", usage=_token_usage, none_is_error=True)
+def get_response(messages, user_id=None):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=1200,
-            temperature=0.7
+        # Scheduling, retries, per-attempt timeouts and hedging live in llm_utils
+        return scheduled_completion(messages, stream=False, user_id=user_id)
+    except SchedulerRejected as e:
+        st.error(str(e))
+        return None
+    except Exception as e:
+        st.error(f"Error getting response: {str(e)}")
+        return None
+
+
+@timed("get_response_stream", usage=_token_usage, none_is_error=True)
+def get_response_stream(messages, placeholder, user_id=None):
+    """Streaming variant of get_response that renders partial output into placeholder.
+
+    Returns the same dict as get_response: the raw content (formatted by the
+    caller, exactly like non-streaming mode) and token usage from the final chunk.
+    """
+    preview = StreamingPreview(
+        lambda text: placeholder.markdown(f"🤖 **Solution:**\n{text}", unsafe_allow_html=True)
+    )
+    try:
+        # A coalesced caller gets the finished answer without the live preview
+        result = scheduled_completion(
+            messages,
+            stream=True,
+            user_id=user_id,
+            on_chunk=preview.feed,
+            on_restart=preview.reset
         )
-        # Return both the response content and token usage
-        return {
-            "content": response.choices[0].message.content,
-            "token_usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens,
-                "model": response.model
-            }
-        }
+        preview.finish()
+        return result
+    except SchedulerRejected as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Error getting response: {str(e)}")
         return None
 
 
-def format_latex_response(response):
-    if response is None:
-        return ""
-    
-    # Step 1: Fix LaTeX delimiters
-    response = response.replace(r'\(', '$')
-    response = response.replace(r'\)', '$')
-    response = response.replace(r'\[', '$$')
-    response = response.replace(r'\]', '$$')
-    
-    # Step 2: Fix common LaTeX commands
-    latex_commands = {
-        r'(?<!\\)alpha': r'\\alpha',
-        r'(?<!\\)beta': r'\\beta',
-        r'(?<!\\)gamma': r'\\gamma',
-        r'(?<!\\)delta': r'\\delta',
-        r'(?<!\\)pi': r'\\pi',
-        r'(?<!\\)theta': r'\\theta',
-        r'(?<!\\)mu': r'\\mu',
-        r'(?<!\\)quad': r'\\quad',
-        r'(?<!\\)text': r'\\text',
-        r'(?<!\\)mod': r'\\mod',
-        r'(?<!\\)div': r'\\div'
-    }
-    
-    for pattern, replacement in latex_commands.items():
-        response = re.sub(pattern, replacement, response)
-    
-    # Step 3: Handle display equations
-    # Split into lines while preserving empty lines
-    lines = response.splitlines()
-    formatted_lines = []
-    
-    for line in lines:
-        # If line contains only a display equation
-        if line.strip().startswith('$$') and line.strip().endswith('$$'):
-            formatted_lines.extend(['', line.strip(), ''])
-        else:
-            formatted_lines.append(line)
-    
-    # Rejoin lines
-    response = '\n'.join(formatted_lines)
-    
-    # Step 4: Clean up spacing
-    # Remove multiple blank lines
-    response = re.sub(r'\n{3,}', '\n\n', response)
-    # Fix spacing around inline equations
-    response = re.sub(r'(?<!\$)\$(?!\$)([^\$]+?)\$(?!\$)', r' $\1$ ', response)
-    # Remove extra spaces
-    response = re.sub(r' +', ' ', response)
-    
-    return response.strip()
-
-# Add this new function after the format_latex_response function
-def update_system_message(subject, question_type):
-    return {
-        "role": "system",
-        "content": f"""You are a helpful tutor specializing in IIT JEE preparation. 
-        Current Subject: {subject if subject else 'Not Specified'}
-        Question Type: {question_type if question_type else 'Not Specified'}
-        
-        Follow these strict rules for mathematical expressions:
-        1. For display/block equations (equations on their own line), ONLY use $$...$$
-        2. For inline equations (equations within text), ONLY use $...$
-        3. Never use [] or () as math delimiters
-        4. Always use \\text{{}} for units
-        5. Add proper spacing with \\, between numbers and units
-        
-        Structure your responses as:
-        - **Question Analysis:** (Brief overview)
-        - **Solution Steps:** (Step-by-step solution, try to stick to the point)
-        - **Final Answer:** (Clear conclusion, matching the question type format)"""
-    }
+def message_block(role, content):
+    """Markdown for one chat message"""
+    if role == "user":
+        return f"📝 Your Question: {content}"
+    return f"🤖 **Solution:**\n{content}"
+
+
+def split_into_turns(messages):
+    """Group the thread (without the system message) into turns that start at a user message"""
+    turns = []
+    for message in messages:
+        if message["role"] == "system":
+            continue
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def render_message(message):
+    if message["role"] == "user":
+        content = message["content"] if isinstance(message["content"], str) else "Image uploaded"
+        st.info(message_block("user", content))
+    elif message["role"] == "assistant":
+        st.markdown(message_block("assistant", message["content"]), unsafe_allow_html=True)
+
+
+def show_more_history():
+    st.session_state["history_pages"] = st.session_state.get("history_pages", 1) + 1
+
+
+@st.fragment
+def render_chat_history():
+    # A fragment, so loading earlier turns reruns only this block
+    turns = split_into_turns(st.session_state["messages"])
+    visible = HISTORY_PAGE_TURNS * st.session_state.get("history_pages", 1)
+    hidden = max(0, len(turns) - visible)
+    if hidden:
+        st.button(
+            f"Show {min(hidden, HISTORY_PAGE_TURNS)} earlier turn(s) of {hidden}",
+            on_click=show_more_history
+        )
+    for turn in turns[hidden:]:
+        for message in turn:
+            render_message(message)
+
+
+def render_similar_questions(question_text, subject):
+    """Past solved questions like this one, shown while the student is still typing"""
+    key = (question_text, subject)
+    if st.session_state.get("similar_key") != key:
+        st.session_state["similar_questions"] = similar_questions(question_text, subject)
+        # Until the index has loaded there's nothing to keep; ask again on the next rerun
+        if index_ready():
+            st.session_state["similar_key"] = key
+    similar = st.session_state["similar_questions"]
+    if not similar:
+        return
+    with st.expander(f"📚 {len(similar)} similar solved question(s)"):
+        for question in similar:
+            st.info(message_block("user", question["question_text"]))
+            st.markdown(message_block("assistant", question["answer"]), unsafe_allow_html=True)
+
+
+@st.fragment
+def render_feedback_form():
+    # A fragment, so typing or submitting feedback doesn't re-render the whole page
+    feedback_text = st.text_area("Leave your feedback", height=70)
+    if st.button("Submit Feedback"):
+        add_feedback(st.session_state["user_id"], question_id=st.session_state["question_id"], feedback_text=feedback_text, rating=None)
+        st.success("Thank you for your feedback!")
+
 
 # Authentication flow
 st.sidebar.title("Login / Signup")
+# A signed session cookie logs a refreshed page back in without bcrypt or Mongo
+restore_session()
 if "authenticated" not in st.session_state:
     st.session_state["authenticated"] = False
     st.session_state["username"] = ""
@@ -224,8 +220,7 @@ if "authenticated" not in st.session_state:
 if st.session_state["authenticated"]:
     st.sidebar.write(f"Welcome, {st.session_state['username']}!")
     if st.sidebar.button("Logout"):
-        st.session_state["authenticated"] = False
-        st.session_state["username"] = ""
+        end_session()
 else:
     # Signup/Login Form
     option = st.sidebar.selectbox("Choose Option", ["Login", "Signup"])
@@ -233,27 +228,28 @@ else:
     password = st.sidebar.text_input("Password", type="password")
     
     if st.sidebar.button(option):
-        if option == "Signup":
-            if not get_user(username):
-                hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-                add_user(username, hashed_password)
-                # st.success("Signup successful. Please log in.")
-                st.sidebar.success("Signup successful. Please log in.")
-            else:
-                # st.error("Username already exists. Please choose another.")
-                st.sidebar.error("Username already exists. Please choose another.")
-        elif option == "Login":
-            user = get_user(username)
-            if user and bcrypt.checkpw(password.encode(), user["password_hash"]):
-                st.session_state["authenticated"] = True
-                st.session_state["username"] = username
-                st.session_state["user_id"] = user["_id"]
-                # st.success("Logged in successfully.")
-                st.sidebar.success("Logged in successfully.")
-                
-            else:
-                # st.error("Invalid username or password.")
-                st.sidebar.error("Invalid username or password.")
+        # bcrypt runs in auth_utils' bounded pool, one hash per core at a time
+        try:
+            if option == "Signup":
+                if not get_user(username) and add_user(username, hash_password(password)):
+                    # st.success("Signup successful. Please log in.")
+                    st.sidebar.success("Signup successful. Please log in.")
+                else:
+                    # st.error("Username already exists. Please choose another.")
+                    st.sidebar.error("Username already exists. Please choose another.")
+            elif option == "Login":
+                user = get_user(username)
+                if user and check_password(password, user.get("password_hash")):
+                    if needs_rehash(user["password_hash"]):
+                        set_password_hash(username, hash_password(password))
+                    start_session(user["_id"], username)
+                    # st.success("Logged in successfully.")
+                    st.sidebar.success("Logged in successfully.")
+                else:
+                    # st.error("Invalid username or password.")
+                    st.sidebar.error("Invalid username or password.")
+        except AuthBusy as e:
+            st.sidebar.error(str(e))
 
 
 # Main app content
@@ -299,133 +295,246 @@ if st.session_state["authenticated"]:
     with col2:
         image_question = st.file_uploader("Or upload an image of your question", type=["jpg", "png", "jpeg"])
         
-    # Image preview and upload handling
-    if image_question:
-        # Check if this image has already been uploaded
-        file_hash = hash(image_question.getvalue())
+    # Attribute the timings below to the selected subject and question type
+    with metric_labels(selected_subject, selected_question_type):
+        # Only for new text questions; follow-ups belong to the current thread
+        if text_question and not image_question and "question_id" not in st.session_state:
+            render_similar_questions(text_question, selected_subject)
+
+        # Image preview and upload handling
+        if image_question:
+            # Check if this image has already been uploaded
+            file_hash = image_sha256(image_question.getvalue())
         
-        if "current_image_hash" not in st.session_state or st.session_state.current_image_hash != file_hash:
-            # New image uploaded
-            st.session_state.current_image_hash = file_hash
-            image_url = upload_image_to_imagekit(image_question, selected_subject)
-            if image_url:
-                st.session_state.current_image_url = image_url
+            if "current_image_hash" not in st.session_state or st.session_state.current_image_hash != file_hash:
+                # New image uploaded: shrink it once, then upload the processed bytes
+                st.session_state.current_image_hash = file_hash
+                try:
+                    st.session_state.current_image_prep = preprocess_image(image_question.getvalue())
+                except OSError:
+                    # Pillow can't read it (UnidentifiedImageError is an OSError); send it untouched
+                    st.session_state.current_image_prep = unprocessed_image(image_question.getvalue())
+                if IMAGE_INLINE_UPLOAD:
+                    # The model gets the image inline, so nothing has to wait for this
+                    st.session_state.current_image_url = None
+                    st.session_state.current_image_upload = start_upload(
+                        get_imagekit(),
+                        st.session_state.current_image_prep["bytes"],
+                        os.path.splitext(image_question.name)[0] + ".jpg",
+                        selected_subject
+                    )
+                else:
+                    st.session_state.current_image_url = upload_image_to_imagekit(
+                        st.session_state.current_image_prep["bytes"],
+                        os.path.splitext(image_question.name)[0] + ".jpg",
+                        selected_subject
+                    )
         
-        # Display preview
-        st.markdown('<div class="image-container">', unsafe_allow_html=True)
-        st.image(
-            image_question,
-            caption="Uploaded Question",
-            # use_column_width=False,
-            width=200
-        )
-        st.markdown('</div>', unsafe_allow_html=True)
+            # Display preview
+            st.markdown('<div class="image-container">', unsafe_allow_html=True)
+            st.image(
+                image_question,
+                caption="Uploaded Question",
+                # use_column_width=False,
+                width=200
+            )
+            st.markdown('</div>', unsafe_allow_html=True)
 
-    if st.button("Get Solution"):
-        if text_question or image_question:
-            # Check if we're continuing an existing question
-            current_question_id = st.session_state.get("question_id")
-            can_proceed = True
+        if st.button("Get Solution"):
+            if text_question or image_question:
+                # Check if we're continuing an existing question
+                current_question_id = st.session_state.get("question_id")
+                can_proceed = True
             
-            if current_question_id:
-                # Check message limit
-                user_message_count = count_user_messages(current_question_id)
-                if user_message_count >= 3:
-                    st.error("You've reached the maximum number of follow-up questions (3) for this topic. Please click 'New Question' to start a new topic.")
-                    can_proceed = False
+                if current_question_id:
+                    wait_for_image_question()
+                    # Check message limit
+                    user_message_count = count_user_messages(current_question_id)
+                    if user_message_count >= 3:
+                        st.error("You've reached the maximum number of follow-up questions (3) for this topic. Please click 'New Question' to start a new topic.")
+                        can_proceed = False
             
-            if can_proceed:
-                # Initialize user_message
-                user_message = None
-
-                # Handle image upload and prepare user message
-                if image_question:
-                    image_url = upload_image_to_imagekit(image_question, selected_subject)
-                    if not image_url:
-                        st.error("Failed to upload image")
-                        can_proceed = False  # Set flag to prevent further processing
-                    else:
-                        # Create new question document
-                        question_id = add_question(
-                            st.session_state["user_id"], 
-                            text_question, 
-                            image_url,
-                            selected_subject, 
-                            selected_question_type
-                        )
-                        st.session_state["question_id"] = question_id
-
-                        # Prepare user message with ImageKit URL
+                if can_proceed:
+                    # Initialize user_message
+                    user_message = None
+                    # Set when the user turn is saved in the background with the image question
+                    user_turn_saved = False
+                    image_report = None
+                    context_report = None
+
+                    # Handle image upload and prepare user message
+                    if image_question and IMAGE_INLINE_UPLOAD:
+                        image_part = {"type": "image_url", "image_url": {
+                            "url": data_url(st.session_state.current_image_prep["bytes"]),
+                            "detail": vision_detail(selected_subject)
+                        }}
                         content = [
                             {"type": "text", "text": text_question if text_question else "Please analyze this question and provide a step-by-step solution. Use LaTeX notation for all mathematical expressions."},
-                            {"type": "image_url", "image_url": {"url": image_url}}
+                            image_part
                         ]
-                        user_message = {"role": "user", "content": content}
-                else:
-                    # Text-only question
-                    if not current_question_id:
-                        question_id = add_question(
-                            st.session_state["user_id"], 
-                            text_question, 
-                            None,
-                            selected_subject, 
-                            selected_question_type
+                        # The insert and the rest of the upload overlap with the model call
+                        question_id, saved = save_image_question(
+                            st.session_state["user_id"],
+                            text_question,
+                            selected_subject,
+                            selected_question_type,
+                            st.session_state.current_image_upload,
+                            content
                         )
                         st.session_state["question_id"] = question_id
+                        st.session_state["pending_image_question"] = (saved, image_part)
+                        user_turn_saved = True
+                        image_report = preprocessing_report(
+                            st.session_state.current_image_prep,
+                            vision_detail(selected_subject)
+                        )
+                        user_message = {"role": "user", "content": content}
+                    elif image_question:
+                        # Reuse the URL from the preview upload instead of uploading again
+                        image_url = st.session_state.get("current_image_url")
+                        if not image_url:
+                            image_url = upload_image_to_imagekit(
+                                st.session_state.current_image_prep["bytes"],
+                                os.path.splitext(image_question.name)[0] + ".jpg",
+                                selected_subject
+                            )
+                            st.session_state.current_image_url = image_url
+                        if not image_url:
+                            st.error("Failed to upload image")
+                            can_proceed = False  # Set flag to prevent further processing
+                        else:
+                            # Create new question document
+                            question_id = add_question(
+                                st.session_state["user_id"], 
+                                text_question, 
+                                image_url,
+                                selected_subject, 
+                                selected_question_type
+                            )
+                            st.session_state["question_id"] = question_id
+
+                            # Prepare user message with ImageKit URL
+                            content = [
+                                {"type": "text", "text": text_question if text_question else "Please analyze this question and provide a step-by-step solution. Use LaTeX notation for all mathematical expressions."},
+                                {"type": "image_url", "image_url": {"url": image_url, "detail": vision_detail(selected_subject)}}
+                            ]
+                            image_report = preprocessing_report(
+                                st.session_state.current_image_prep,
+                                vision_detail(selected_subject)
+                            )
+                            user_message = {"role": "user", "content": content}
                     else:
-                        question_id = current_question_id
+                        # Text-only question
+                        if not current_question_id:
+                            question_id = add_question(
+                                st.session_state["user_id"], 
+                                text_question, 
+                                None,
+                                selected_subject, 
+                                selected_question_type
+                            )
+                            st.session_state["question_id"] = question_id
+                        else:
+                            question_id = current_question_id
                     
-                    user_message = {"role": "user", "content": text_question}
-
-                # Ensure user_message is defined before using it
-                if user_message:
-                    # Add the user message to session state and database
-                    st.session_state["messages"].append(user_message)
-                    add_message_to_question(question_id, "user", user_message["content"])
-
-                    # Get AI response
-                    with st.spinner("Thinking..."):
-                        ai_response = get_response(st.session_state["messages"])
-                        print("\n\n\n")
-                        print(st.session_state["messages"])
-                        print("\n\n\n")
-                        print(ai_response)
-
-                    if ai_response:
-                        formatted_response = format_latex_response(ai_response["content"])
-                        response_message = {"role": "assistant", "content": formatted_response}
-                        st.session_state["messages"].append(response_message)
-                        
-                        # Add message to database with token usage information
-                        add_message_to_question(
-                            question_id, 
-                            "assistant", 
-                            formatted_response,
-                            token_info=ai_response.get("token_usage")
-                        )
-        else:
-            st.warning("Please enter a question or upload an image.")
+                        user_message = {"role": "user", "content": text_question}
+
+                    # Ensure user_message is defined before using it
+                    if user_message:
+                        # Add the user message to session state and database
+                        st.session_state["messages"].append(user_message)
+                        if not user_turn_saved:
+                            add_message_to_question(question_id, "user", user_message["content"])
+
+                        # Only first turns are cacheable; follow-ups depend on the whole thread
+                        cache_key = None
+                        if len(st.session_state["messages"]) == 2:
+                            cache_key = make_cache_key(
+                                text_question,
+                                selected_subject,
+                                selected_question_type,
+                                image_question.getvalue() if image_question else None
+                            )
+                        cached_response = get_cached_response(cache_key) if cache_key else None
+
+                        formatted_response = None
+                        token_info = None
+                        if cached_response:
+                            formatted_response = cached_response["content"]
+                            cached_usage = cached_response.get("token_usage") or {}
+                            token_info = {
+                                "prompt_tokens": 0,
+                                "completion_tokens": 0,
+                                "total_tokens": 0,
+                                "model": cached_usage.get("model"),
+                                "cache_hit": True
+                            }
+                        else:
+                            # Plain arithmetic and algebra are answered locally, without a model call
+                            ai_response = None
+                            if not image_question and len(st.session_state["messages"]) == 2:
+                                ai_response = symbolic_response(text_question, selected_question_type)
+
+                            if ai_response is None:
+                                # Session state keeps the full thread for display; the model gets a budgeted copy
+                                request_messages, context_report = build_context(st.session_state["messages"])
+
+                                # Get AI response
+                                if STREAM_RESPONSES:
+                                    stream_placeholder = st.empty()
+                                    ai_response = get_response_stream(
+                                        request_messages,
+                                        stream_placeholder,
+                                        user_id=st.session_state["user_id"]
+                                    )
+                                    # The full answer is rendered again in the chat history below
+                                    stream_placeholder.empty()
+                                else:
+                                    with st.spinner("Thinking..."):
+                                        ai_response = get_response(request_messages, user_id=st.session_state["user_id"])
+
+                            if ai_response:
+                                formatted_response = format_latex_response(ai_response["content"])
+                                token_info = ai_response.get("token_usage")
+                                if cache_key:
+                                    cache_response(cache_key, formatted_response, token_info)
+
+                        if formatted_response is not None:
+                            if image_report and token_info:
+                                token_info = {**token_info, "image_preprocessing": image_report}
+                            if context_report and token_info:
+                                token_info = {**token_info, "context": context_report}
+                            response_message = {"role": "assistant", "content": formatted_response}
+                            st.session_state["messages"].append(response_message)
+
+                            # The answer goes after the user turn, which may still be saving
+                            wait_for_image_question()
+                            # Add message to database with token usage information
+                            add_message_to_question(
+                                question_id, 
+                                "assistant", 
+                                formatted_response,
+                                token_info=token_info
+                            )
+            else:
+                st.warning("Please enter a question or upload an image.")
     
     # Display chat history
     st.subheader("Solution and Discussion")
-    for message in st.session_state["messages"]:
-        if message["role"] == "user":
-            st.info(f"📝 Your Question: {message['content'] if isinstance(message['content'], str) else 'Image uploaded'}")
-        elif message["role"] == "assistant":
-            st.markdown(f"🤖 **Solution:**\n{message['content']}", unsafe_allow_html=True)
+    render_chat_history()
 
     # Feedback section
     st.subheader("Feedback")
-    feedback_text = st.text_area("Leave your feedback", height=70)
-    if st.button("Submit Feedback"):
-        add_feedback(st.session_state["user_id"], question_id=st.session_state["question_id"], feedback_text=feedback_text, rating=None)
-        st.success("Thank you for your feedback!")
+    render_feedback_form()
 
     # Modify the New Question button to clear the question_id
     if st.button("New Question 🆕"):
         # Clear the question ID to start fresh
         if "question_id" in st.session_state:
             del st.session_state["question_id"]
+        # An unanswered image question finishes saving on its own; the new question doesn't wait for it
+        st.session_state.pop("pending_image_question", None)
+        st.session_state["history_pages"] = 1
         
         # Reset messages with the stored selections
         st.session_state["messages"] = [update_system_message(selected_subject, selected_question_type)]
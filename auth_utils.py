@@ -0,0 +1,198 @@
+# auth_utils.py
+"""Password hashing off the script thread, and signed session tokens.
+
+bcrypt is deliberately slow, so hashing and checking run in a pool of
+AUTH_WORKERS threads (one per core by default). bcrypt releases the GIL
+while it hashes, so the pool uses every core, and a login burst queues for
+a core instead of oversubscribing the CPU that running scripts need. It is
+a thread pool rather than a process pool because Streamlit runs the page as
+__main__, which spawned workers would re-execute. The cost factor for new
+hashes is BCRYPT_ROUNDS; older hashes keep verifying at whatever cost they
+were made with, and are re-hashed on the next successful login.
+
+After a login the browser gets a session cookie: the user id, username and
+expiry, signed with HMAC-SHA256. A refresh is then authenticated from the
+cookie alone, with no bcrypt and no Mongo. The cookie is kept out of the
+URL so it can't leak through history, shared links or referrers, and is
+SameSite=Strict (and Secure over HTTPS). It is set from the page's
+JavaScript, so it can't be HttpOnly, and a token can't be revoked before it
+expires: keep SESSION_TTL short, and rotate SESSION_SECRET to sign everyone out.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from dotenv import load_dotenv
+
+# Pages may import this before resources, and the settings below are read once at import
+load_dotenv()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", str(os.cpu_count() or 1)))
+# Seconds a login may wait for a free worker plus the hash itself
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "10"))
+
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(12 * 3600)))
+SESSION_COOKIE = "doubt_solver_session"
+
+_pool = None
+_pool_lock = threading.Lock()
+_secret = None
+
+
+class AuthBusy(Exception):
+    """The pool couldn't get to a password check within AUTH_TIMEOUT"""
+
+
+def _hash(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds))
+
+
+def _check(password, password_hash):
+    import bcrypt
+    return bcrypt.checkpw(password.encode(), password_hash)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="bcrypt")
+    return _pool
+
+
+def _run(fn, *args):
+    future = _get_pool().submit(fn, *args)
+    try:
+        return future.result(timeout=AUTH_TIMEOUT)
+    except FutureTimeout:
+        future.cancel()
+        raise AuthBusy("Too many people are logging in right now. Please try again in a moment.")
+
+
+def hash_password(password, rounds=None):
+    """bcrypt hash of password at BCRYPT_ROUNDS, computed in the pool"""
+    return _run(_hash, password, rounds or BCRYPT_ROUNDS)
+
+
+def check_password(password, password_hash):
+    """Whether password matches password_hash, checked in the pool"""
+    if not password_hash:
+        return False
+    return _run(_check, password, password_hash)
+
+
+def needs_rehash(password_hash):
+    """Whether a hash was made at a different cost than BCRYPT_ROUNDS"""
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode()
+    try:
+        return int(password_hash.split(b"$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+def _get_secret():
+    global _secret
+    if _secret is None:
+        if SESSION_SECRET:
+            _secret = SESSION_SECRET.encode()
+        else:
+            print("SESSION_SECRET is not set; session tokens won't survive a restart or work across servers.")
+            _secret = secrets.token_bytes(32)
+    return _secret
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(_get_secret(), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_session_token(user_id, username, ttl=SESSION_TTL):
+    """Signed token for a logged-in user"""
+    payload = _b64encode(json.dumps(
+        {"id": str(user_id), "u": username, "exp": int(time.time()) + ttl},
+        separators=(",", ":")
+    ).encode())
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_session_token(token):
+    """(user_id, username) from a valid unexpired token, else None"""
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+        if claims["exp"] < time.time():
+            return None
+        return claims["id"], claims["u"]
+    except (ValueError, AttributeError, KeyError, TypeError):
+        return None
+
+
+def _write_cookie(value, max_age):
+    import streamlit as st
+
+    # Runs in the page itself (not an iframe), so the cookie belongs to the app's origin
+    st.html(
+        "<script>document.cookie = "
+        f"'{SESSION_COOKIE}={value}; Max-Age={max_age}; Path=/; SameSite=Strict'"
+        " + (location.protocol === 'https:' ? '; Secure' : '');</script>",
+        unsafe_allow_javascript=True
+    )
+
+
+def start_session(user_id, username):
+    """Mark this session logged in and give the browser a session cookie"""
+    import streamlit as st
+
+    st.session_state["authenticated"] = True
+    st.session_state["username"] = username
+    st.session_state["user_id"] = str(user_id)
+    st.session_state.pop("logged_out", None)
+    _write_cookie(issue_session_token(user_id, username), SESSION_TTL)
+
+
+def end_session():
+    """Log this session out and delete the browser's session cookie"""
+    import streamlit as st
+
+    st.session_state["authenticated"] = False
+    st.session_state["username"] = ""
+    # The cookie sent when this session connected stays visible to it until a reload
+    st.session_state["logged_out"] = True
+    _write_cookie("", 0)
+
+
+def restore_session():
+    """Log the session in from its session cookie; True if it's authenticated"""
+    import streamlit as st
+
+    if st.session_state.get("authenticated"):
+        return True
+    if st.session_state.get("logged_out"):
+        return False
+    token = st.context.cookies.get(SESSION_COOKIE)
+    user = verify_session_token(token) if token else None
+    if not user:
+        return False
+    st.session_state["authenticated"] = True
+    st.session_state["user_id"], st.session_state["username"] = user
+    return True
@@ -0,0 +1,230 @@
+# batch_solve.py
+"""Pre-solve a question paper so students get cached answers instantly.
+
+Reads a JSONL or CSV file with one question per row:
+
+    id, text, image (path, relative to the input file), subject, question_type
+
+and solves the rows concurrently through the app's pipeline: image
+preprocessing and upload, the symbolic fast path, update_system_message and
+the scheduled model call, then format_latex_response. Every answer goes
+into the answer cache under the same key a student's identical question
+produces, and is bulk-inserted as a solved question owned by --username.
+
+Progress is appended to a checkpoint file after each insert, so rerunning
+the same command resumes where it stopped.
+
+    python batch_solve.py paper.jsonl --username 9999999999 [--workers 4]
+        [--batch-size 25] [--checkpoint paper.jsonl.done] [--force]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache_utils import cache_response, get_cached_response, make_cache_key
+from db_utils import add_solved_questions, get_user
+from image_utils import get_or_upload_image, preprocess_image, preprocessing_report, vision_detail
+from latex_utils import format_latex_response
+from llm_utils import scheduled_completion, update_system_message
+from metrics_utils import estimate_cost, metric_labels
+from resources import get_imagekit
+from symbolic_utils import symbolic_response
+
+# Scheduler fairness key: interactive users are served round-robin ahead of a long batch
+BATCH_USER = "batch_solve"
+DEFAULT_PROMPT = "Please analyze this question and provide a step-by-step solution. Use LaTeX notation for all mathematical expressions."
+
+
+def read_questions(path):
+    """Rows of a .jsonl or .csv file, each with an id (line number if missing)"""
+    with open(path, newline="", encoding="utf-8") as source:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(source))
+        else:
+            rows = [json.loads(line) for line in source if line.strip()]
+    base_dir = os.path.dirname(os.path.abspath(path))
+    questions = []
+    for number, row in enumerate(rows, 1):
+        image = row.get("image") or row.get("image_path")
+        questions.append({
+            "id": str(row.get("id") or number),
+            "text": (row.get("text") or row.get("question_text") or "").strip(),
+            "image": os.path.join(base_dir, image) if image else None,
+            "subject": row.get("subject") or "None",
+            "question_type": row.get("question_type") or "None"
+        })
+    return questions
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as checkpoint:
+        return {json.loads(line)["id"] for line in checkpoint if line.strip()}
+
+
+def solve_question(question, force=False):
+    """Solve one row; returns the solved item, or {"status": "cached"} if already warm"""
+    image_bytes = None
+    if question["image"]:
+        with open(question["image"], "rb") as image_file:
+            image_bytes = image_file.read()
+    if not question["text"] and not image_bytes:
+        raise ValueError("row has neither text nor image")
+
+    # The raw file bytes, like a student's upload, so their identical question hits this entry
+    cache_key = make_cache_key(question["text"], question["subject"], question["question_type"], image_bytes)
+    if not force and get_cached_response(cache_key):
+        return {"status": "cached"}
+
+    with metric_labels(question["subject"], question["question_type"]):
+        image_url = None
+        image_report = None
+        response = None
+        if image_bytes:
+            prepared = preprocess_image(image_bytes)
+            detail = vision_detail(question["subject"])
+            file_name = os.path.splitext(os.path.basename(question["image"]))[0] + ".jpg"
+            image_url = get_or_upload_image(get_imagekit(), prepared["bytes"], file_name, question["subject"])
+            image_report = preprocessing_report(prepared, detail)
+            user_content = [
+                {"type": "text", "text": question["text"] or DEFAULT_PROMPT},
+                {"type": "image_url", "image_url": {"url": image_url, "detail": detail}}
+            ]
+        else:
+            user_content = question["text"]
+            response = symbolic_response(question["text"], question["question_type"])
+
+        if response is None:
+            messages = [
+                update_system_message(question["subject"], question["question_type"]),
+                {"role": "user", "content": user_content}
+            ]
+            response = scheduled_completion(messages, user_id=BATCH_USER)
+
+    answer = format_latex_response(response["content"])
+    token_usage = response["token_usage"]
+    if image_report:
+        token_usage = {**token_usage, "image_preprocessing": image_report}
+    cache_response(cache_key, answer, token_usage)
+    return {
+        "status": "solved",
+        "question_text": question["text"],
+        "user_content": user_content,
+        "image_url": image_url,
+        "subject": question["subject"],
+        "question_type": question["question_type"],
+        "answer": answer,
+        "token_usage": token_usage
+    }
+
+
+class Progress:
+    """Buffers solved rows, bulk-inserts them and appends them to the checkpoint"""
+
+    def __init__(self, user_id, checkpoint_path, batch_size):
+        self.user_id = user_id
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.pending = []
+        self.counts = {"solved": 0, "cached": 0, "failed": 0}
+        self.tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self.cost_usd = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, question_id, result):
+        with self._lock:
+            self.counts[result["status"]] += 1
+            if result["status"] == "cached":
+                self._checkpoint([{"id": question_id, "status": "cached"}])
+                return
+            for field in self.tokens:
+                self.tokens[field] += result["token_usage"].get(field) or 0
+            self.cost_usd += estimate_cost(result["token_usage"])
+            self.pending.append((question_id, result))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def fail(self, question_id, error):
+        with self._lock:
+            self.counts["failed"] += 1
+        # Failures aren't checkpointed, so the next run retries them
+        print(f"[{question_id}] failed: {error}")
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        ids = add_solved_questions(self.user_id, [result for _, result in self.pending])
+        self._checkpoint([
+            {"id": question_id, "status": "solved", "question_id": inserted_id}
+            for (question_id, _), inserted_id in zip(self.pending, ids)
+        ])
+        self.pending = []
+
+    def _checkpoint(self, entries):
+        with open(self.checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            for entry in entries:
+                checkpoint.write(json.dumps(entry) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-solve a question paper into the answer cache")
+    parser.add_argument("input", help="JSONL or CSV of questions")
+    parser.add_argument("--username", required=True, help="Account that will own the solved questions")
+    parser.add_argument("--workers", type=int, default=4, help="Questions solved concurrently")
+    parser.add_argument("--batch-size", type=int, default=25, help="Solved questions per bulk insert")
+    parser.add_argument("--checkpoint", help="Progress file (default: <input>.done)")
+    parser.add_argument("--force", action="store_true", help="Re-solve questions that are already cached")
+    args = parser.parse_args()
+
+    user = get_user(args.username)
+    if not user:
+        print(f"No user named {args.username!r}; sign up in the app first.")
+        return 2
+
+    checkpoint_path = args.checkpoint or f"{args.input}.done"
+    done = read_checkpoint(checkpoint_path)
+    questions = [question for question in read_questions(args.input) if question["id"] not in done]
+    print(f"{len(questions)} question(s) to solve, {len(done)} already done")
+
+    progress = Progress(user["_id"], checkpoint_path, args.batch_size)
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(solve_question, question, args.force): question["id"] for question in questions}
+            for finished, future in enumerate(as_completed(futures), 1):
+                question_id = futures[future]
+                try:
+                    progress.add(question_id, future.result())
+                except Exception as e:
+                    progress.fail(question_id, e)
+                if finished % 10 == 0:
+                    print(f"{finished}/{len(questions)} done")
+    finally:
+        progress.flush()
+
+    elapsed = time.perf_counter() - start
+    counts, tokens = progress.counts, progress.tokens
+    print(
+        f"solved {counts['solved']}, already cached {counts['cached']}, failed {counts['failed']} "
+        f"in {elapsed:.1f}s ({len(questions) / elapsed if elapsed else 0:.2f} questions/s)"
+    )
+    print(
+        f"tokens: {tokens['prompt_tokens']:,} prompt + {tokens['completion_tokens']:,} completion "
+        f"= {tokens['total_tokens']:,} ({tokens['total_tokens'] / elapsed if elapsed else 0:,.0f}/s), "
+        f"estimated cost ${progress.cost_usd:.4f}"
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
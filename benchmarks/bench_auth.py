@@ -0,0 +1,92 @@
+# benchmarks/bench_auth.py
+"""Logins per second through auth_utils' bcrypt pool.
+
+Each login is one bcrypt check, as in app.py. For every cost factor the
+pool is driven with --concurrency simultaneous logins per worker count, so
+the report shows throughput, throughput per core and login latency as
+workers are added. Verifying a session token, which is what a returning
+user costs instead, is measured for comparison.
+
+    python benchmarks/bench_auth.py [--rounds 10 12] [--workers 1 2 4]
+        [--logins 64] [--concurrency 32]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "bench-password"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench_pool(workers, password_hash, logins, concurrency):
+    import auth_utils
+
+    auth_utils.AUTH_WORKERS = workers
+    auth_utils.AUTH_TIMEOUT = 600
+    auth_utils._pool = None
+    # Start the workers before timing, like a server that has already served a login
+    pool = auth_utils._get_pool()
+    for future in [pool.submit(auth_utils._check, PASSWORD, password_hash) for _ in range(workers)]:
+        future.result()
+
+    def login(_):
+        start = time.perf_counter()
+        if not auth_utils.check_password(PASSWORD, password_hash):
+            raise RuntimeError("password check failed")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as callers:
+        latencies = list(callers.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return logins / elapsed, latencies
+
+
+def bench_tokens(count):
+    from auth_utils import issue_session_token, verify_session_token
+
+    token = issue_session_token("0" * 24, "9999999999")
+    start = time.perf_counter()
+    for _ in range(count):
+        verify_session_token(token)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bcrypt login throughput benchmark")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 12], help="bcrypt cost factors")
+    parser.add_argument("--workers", type=int, nargs="+", help="Pool sizes (default: 1 up to the core count)")
+    parser.add_argument("--logins", type=int, default=64, help="Logins per measurement")
+    parser.add_argument("--concurrency", type=int, default=32, help="Simultaneous logins")
+    args = parser.parse_args()
+
+    import bcrypt
+
+    cores = os.cpu_count() or 1
+    workers = args.workers or sorted({1, max(1, cores // 2), cores})
+    print(f"{cores} core(s); {args.logins} logins per measurement, {args.concurrency} at a time")
+    for rounds in args.rounds:
+        password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds))
+        for count in workers:
+            rate, latencies = bench_pool(count, password_hash, args.logins, args.concurrency)
+            print(
+                f"cost {rounds:>2}, {count:>2} worker(s): {rate:8.1f} logins/s  "
+                f"{rate / min(count, cores):7.1f}/s per core  "
+                f"p50 {percentile(latencies, 0.5) * 1000:8.1f} ms  p95 {percentile(latencies, 0.95) * 1000:8.1f} ms"
+            )
+    print(f"session token check: {bench_tokens(20000):,.0f}/s on one thread")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
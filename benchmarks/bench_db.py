@@ -0,0 +1,144 @@
+# benchmarks/bench_db.py
+"""Before/after benchmark for the db_utils read paths against a local MongoDB.
+
+Seeds a scratch database with users and questions shaped like production
+documents, times the original access patterns (full-document fetch to count
+user turns, unindexed username lookup), then creates the indexes and times
+the projection/counter versions in db_utils.
+
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_db.py --questions 1000000
+
+The scratch database (default doubt_solver_bench) is dropped first unless
+--reuse is given.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ["MONGODB_DB"] = os.getenv("BENCH_MONGODB_DB", "doubt_solver_bench")
+
+from bson import ObjectId  # noqa: E402
+
+import db_utils  # noqa: E402
+
+SOLUTION_BODY = (
+    "**Question Analysis:** ...\n\n**Solution Steps:**\n"
+    + "1. $F = ma$ so $a = \\frac{F}{m}$\n" * 40
+    + "\n**Final Answer:** 4"
+)
+
+
+def seed(num_users, num_questions, batch_size=5000):
+    db_utils.client.drop_database(db_utils.db.name)
+    user_ids = [ObjectId() for _ in range(num_users)]
+    db_utils.users_collection.insert_many([
+        {"_id": user_id, "username": f"9{i:09d}", "password_hash": b"x" * 60}
+        for i, user_id in enumerate(user_ids)
+    ])
+
+    start = datetime.now() - timedelta(days=365)
+    inserted = 0
+    while inserted < num_questions:
+        batch = []
+        for _ in range(min(batch_size, num_questions - inserted)):
+            text = f"A block of mass {random.randint(1, 20)} kg slides down an incline..."
+            batch.append({
+                "user_id": random.choice(user_ids),
+                "question_text": text,
+                "image_base64": None,
+                "subject": random.choice(["Physics", "Chemistry", "Mathematics", "Biology"]),
+                "question_type": "Integer Type",
+                "messages": [
+                    {"role": "user", "content": text},
+                    {"role": "user", "content": text, "timestamp": start},
+                    {"role": "assistant", "content": SOLUTION_BODY, "timestamp": start}
+                ],
+                "user_message_count": 2,
+                "timestamp": start + timedelta(seconds=inserted)
+            })
+            inserted += 1
+        db_utils.questions_collection.insert_many(batch, ordered=False)
+        print(f"\rseeded {inserted}/{num_questions} questions", end="", flush=True)
+    print()
+    return user_ids
+
+
+def legacy_count_user_messages(question_id):
+    question = db_utils.questions_collection.find_one({"_id": ObjectId(question_id)})
+    if not question or "messages" not in question:
+        return 0
+    return sum(1 for msg in question["messages"] if msg["role"] == "user")
+
+
+def legacy_get_user(username):
+    return db_utils.users_collection.find_one({"username": username})
+
+
+def timed(func, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": statistics.median(samples),
+        "p95_ms": samples[int(len(samples) * 0.95) - 1],
+        "mean_ms": statistics.fmean(samples)
+    }
+
+
+def report(name, before, after):
+    print(
+        f"{name:>22}: before p50 {before['p50_ms']:8.2f} ms  p95 {before['p95_ms']:8.2f} ms | "
+        f"after p50 {after['p50_ms']:7.2f} ms  p95 {after['p95_ms']:7.2f} ms "
+        f"({before['mean_ms'] / after['mean_ms']:.0f}x)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db_utils before/after benchmark")
+    parser.add_argument("--questions", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--reuse", action="store_true", help="Skip seeding and reuse the scratch database")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        seed(args.users, args.questions)
+    # "Before" means no secondary indexes at all
+    db_utils.users_collection.drop_indexes()
+    db_utils.questions_collection.drop_indexes()
+    db_utils.feedback_collection.drop_indexes()
+
+    question_ids = [
+        (str(doc["_id"]),)
+        for doc in db_utils.questions_collection.aggregate([
+            {"$sample": {"size": args.samples}}, {"$project": {"_id": 1}}
+        ])
+    ]
+    usernames = [(f"9{random.randrange(args.users):09d}",) for _ in range(min(args.samples, 100))]
+
+    count_before = timed(legacy_count_user_messages, question_ids)
+    user_before = timed(legacy_get_user, usernames)
+
+    db_utils.ensure_indexes()
+
+    count_after = timed(db_utils.count_user_messages, question_ids)
+    user_after = timed(db_utils.get_user, usernames)
+
+    report("count_user_messages", count_before, count_after)
+    report("get_user", user_before, user_after)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
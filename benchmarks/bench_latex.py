@@ -0,0 +1,135 @@
+# benchmarks/bench_latex.py
+"""Golden-corpus check and throughput benchmark for format_latex_response.
+
+Run from the repo root:
+
+    python benchmarks/bench_latex.py [--repeat 5] [--json results.json]
+
+Exits non-zero if the formatter disagrees with the golden corpus, so it can
+gate CI as well as track throughput while LATEX_COMMANDS grows.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from latex_utils import format_latex_response  # noqa: E402
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "latex_golden.json")
+
+
+def legacy_format_latex_response(response):
+    """The original multi-pass implementation, kept as the speed baseline"""
+    if response is None:
+        return ""
+    response = response.replace(r'\(', '$')
+    response = response.replace(r'\)', '$')
+    response = response.replace(r'\[', '$$')
+    response = response.replace(r'\]', '$$')
+    latex_commands = {
+        r'(?<!\\)alpha': r'\\alpha',
+        r'(?<!\\)beta': r'\\beta',
+        r'(?<!\\)gamma': r'\\gamma',
+        r'(?<!\\)delta': r'\\delta',
+        r'(?<!\\)pi': r'\\pi',
+        r'(?<!\\)theta': r'\\theta',
+        r'(?<!\\)mu': r'\\mu',
+        r'(?<!\\)quad': r'\\quad',
+        r'(?<!\\)text': r'\\text',
+        r'(?<!\\)mod': r'\\mod',
+        r'(?<!\\)div': r'\\div'
+    }
+    for pattern, replacement in latex_commands.items():
+        response = re.sub(pattern, replacement, response)
+    formatted_lines = []
+    for line in response.splitlines():
+        if line.strip().startswith('$$') and line.strip().endswith('$$'):
+            formatted_lines.extend(['', line.strip(), ''])
+        else:
+            formatted_lines.append(line)
+    response = '\n'.join(formatted_lines)
+    response = re.sub(r'\n{3,}', '\n\n', response)
+    response = re.sub(r'(?<!\$)\$(?!\$)([^\$]+?)\$(?!\$)', r' $\1$ ', response)
+    response = re.sub(r' +', ' ', response)
+    return response.strip()
+
+
+def load_golden():
+    with open(GOLDEN_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_golden(golden):
+    """Return the indexes of corpus entries whose output changed"""
+    return [i for i, case in enumerate(golden) if format_latex_response(case["input"]) != case["expected"]]
+
+
+def build_workloads(golden):
+    short = [case["input"][:200] for case in golden]
+    long = ["\n\n".join(case["input"] for case in golden) * 8]
+    pathological = [
+        "$" * 5000,
+        "$a" * 4000,
+        "$$" + "$x$ " * 2000 + "$$",
+        "\\(" * 3000 + "alpha" * 1000 + "\\)" * 3000,
+        "modivtextheta" * 1500,
+    ]
+    return {"short": short, "long": long, "pathological": pathological}
+
+
+def bench(func, inputs, repeat):
+    total_chars = sum(len(text) for text in inputs)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in inputs:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return {
+        "calls_per_sec": len(inputs) / best,
+        "mb_per_sec": total_chars / best / 1e6,
+        "seconds": best
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    golden = load_golden()
+    mismatches = check_golden(golden)
+    if mismatches:
+        print(f"Golden corpus mismatch in entries: {mismatches}")
+        return 1
+    print(f"Golden corpus: {len(golden)} responses match")
+
+    results = {}
+    for name, inputs in build_workloads(golden).items():
+        legacy_outputs = [legacy_format_latex_response(text) for text in inputs]
+        if legacy_outputs != [format_latex_response(text) for text in inputs]:
+            print(f"{name}: output differs from the legacy implementation")
+            return 1
+        current = bench(format_latex_response, inputs, args.repeat)
+        legacy = bench(legacy_format_latex_response, inputs, args.repeat)
+        results[name] = {"current": current, "legacy": legacy}
+        print(
+            f"{name:>12}: {current['calls_per_sec']:10.0f} calls/s "
+            f"{current['mb_per_sec']:7.2f} MB/s "
+            f"({legacy['seconds'] / current['seconds']:.1f}x vs legacy)"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+# benchmarks/bench_load.py
+"""Offline load test: N simulated students driving the real app.py.
+
+Every external service is replaced by a local stand-in, so this runs in CI
+without a network:
+
+- OpenAI: a stub HTTP server speaking the chat completions API (streaming
+  and not) with configurable time-to-first-token, per-token delay, token
+  counts and injected 5xx errors; the real SDK client talks to it.
+- ImageKit: an in-process uploader with configurable latency.
+- MongoDB: mongomock, or a local mongod with --mongo-uri.
+
+Each user runs signup, login, one image question and --follow-ups text
+follow-ups through streamlit.testing's AppTest. AppTest swaps process-global
+runtime state on every run, so concurrent sessions live in --concurrency
+worker processes (each with its own scheduler and caches) that share the
+one stub server. Reported: throughput, per-step latency percentiles and
+memory per live session.
+
+    python benchmarks/bench_load.py [--users 20] [--concurrency 5] [--follow-ups 1]
+        [--ttft-ms 300] [--token-ms 5] [--completion-tokens 250] [--error-rate 0]
+        [--upload-ms 150] [--mongo-uri mongodb://localhost:27017] [--json report.json]
+
+Needs pillow and mongomock (pip install mongomock) besides the app's requirements.
+"""
+import argparse
+import atexit
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STEPS = ("signup", "login", "image_question", "follow_up")
+# app.py stops a thread at 3 user messages, and the opening question already counts as two
+MAX_FOLLOW_UPS = 1
+
+ANSWER = (
+    "**Question Analysis:** The block slides on a frictionless incline of angle \\(\\theta\\). "
+    "**Solution Steps:** Resolving gravity along the incline gives \\(a = g \\sin\\theta\\). "
+    "Using \\(v^2 = u^2 + 2as\\) with \\(u = 0\\): $$v = \\sqrt{2 g s \\sin\\theta}$$ "
+    "**Final Answer:** \\(v = \\sqrt{2 g s \\sin\\theta}\\)"
+).split(" ")
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions; timing knobs live on the server object"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config = self.server.config
+        if random.random() < config["error_rate"]:
+            self._send_json(500, {"error": {"message": "stub overloaded", "type": "server_error"}})
+            return
+
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        completion_tokens = min(config["completion_tokens"], body.get("max_tokens") or 10 ** 9)
+        words = [ANSWER[i % len(ANSWER)] + " " for i in range(completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": "gpt-4o-mini-stub"}
+        time.sleep(config["ttft_ms"] / 1000)
+
+        if not body.get("stream"):
+            time.sleep(config["token_ms"] * completion_tokens / 1000)
+            self._send_json(200, {
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in words:
+                self._send_event({
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]
+                })
+                time.sleep(config["token_ms"] / 1000)
+            self._send_event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+            self._send_chunk(b"data: [DONE]\n\n")
+            self._send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream, e.g. a cancelled hedge
+            pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, payload):
+        self._send_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Workers exiting drop their keep-alive connections; that's not worth a traceback
+        pass
+
+
+def start_stub_openai(ttft_ms, token_ms, completion_tokens, error_rate):
+    server = StubServer(("127.0.0.1", 0), StubOpenAIHandler)
+    server.config = {
+        "ttft_ms": ttft_ms,
+        "token_ms": token_ms,
+        "completion_tokens": completion_tokens,
+        "error_rate": error_rate
+    }
+    threading.Thread(target=server.serve_forever, name="stub-openai", daemon=True).start()
+    return server
+
+
+class FakeImageKit:
+    """Just enough of the imagekitio client for image_utils"""
+
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def upload_file(self, file, file_name, options=None):
+        file.read()
+        time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            self.uploads += 1
+            number = self.uploads
+        return types.SimpleNamespace(file_path=f"/bench/{number}_{file_name}")
+
+    def url(self, options):
+        return f"https://ik.imagekit.invalid{options['path']}?tr=h-300,w-300"
+
+
+def install_fakes(args, openai_url):
+    """Register the stand-ins before app.py (and db_utils) is first imported"""
+    # Keep the similarity index snapshot out of the working directory; set
+    # before resources loads .env, which doesn't override what is already set
+    index_dir = tempfile.mkdtemp(prefix="bench-similarity-")
+    atexit.register(shutil.rmtree, index_dir, ignore_errors=True)
+    os.environ["SIMILARITY_INDEX_DIR"] = index_dir
+
+    from openai import OpenAI
+
+    import resources
+
+    resources.override_resource("openai", OpenAI(api_key="stub", base_url=openai_url))
+    resources.override_resource("imagekit", FakeImageKit(args.upload_ms))
+    if args.mongo_uri:
+        import pymongo
+        resources.override_resource("mongo", pymongo.MongoClient(args.mongo_uri))
+    else:
+        import mongomock
+        resources.override_resource("mongo", mongomock.MongoClient())
+
+
+def question_image(seed):
+    """A distinct, roughly photo-of-a-worksheet sized PNG per user"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (1600, 1200), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(12):
+        y = 200 + line * 60
+        draw.line((150 + rng.randint(0, 80), y, 1300 + rng.randint(0, 150), y), fill="black", width=4)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+
+def _timed_run(at, timings, step):
+    start = time.perf_counter()
+    at.run()
+    timings[step].append(time.perf_counter() - start)
+    if at.exception:
+        raise RuntimeError(f"{step}: {at.exception[0].message}")
+    if at.error:
+        raise RuntimeError(f"{step}: {at.error[0].value}")
+
+
+def simulate_user(number, args, timings, sessions):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=args.timeout)
+    at.run()
+    phone = f"9{args.run_id:04d}{number:05d}"
+
+    at.sidebar.selectbox[0].select("Signup").run()
+    at.sidebar.text_input[0].input(phone)
+    at.sidebar.text_input[1].input("bench-password")
+    _button(at, "Signup").click()
+    _timed_run(at, timings, "signup")
+
+    at.sidebar.selectbox[0].select("Login").run()
+    _button(at, "Login").click()
+    _timed_run(at, timings, "login")
+    if not at.session_state["authenticated"]:
+        raise RuntimeError("login: not authenticated")
+
+    at.file_uploader[0].upload(f"question_{number}.png", question_image(number), "image/png")
+    _button(at, "Get Solution").click()
+    _timed_run(at, timings, "image_question")
+
+    at.file_uploader[0].set_value(None)
+    for turn in range(args.follow_ups):
+        at.text_area[0].input(f"Why is the normal force ignored? ({turn + 1})")
+        _button(at, "Get Solution").click()
+        _timed_run(at, timings, "follow_up")
+
+    # Keep the session alive so its memory is still counted
+    sessions.append(at)
+
+
+def rss_bytes():
+    """Current resident set size (Linux), falling back to the peak"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_worker(numbers, args, openai_url):
+    """Run a share of the users one after another in this worker process"""
+    install_fakes(args, openai_url)
+    # Warm up imports and index creation so they aren't charged to the first user
+    from streamlit.testing.v1 import AppTest
+    AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=args.timeout).run()
+
+    import resources
+    timings = {step: [] for step in STEPS}
+    sessions = []
+    failures = []
+    baseline_rss = rss_bytes()
+    started_at = time.time()
+    for number in numbers:
+        try:
+            simulate_user(number, args, timings, sessions)
+        except Exception as e:
+            failures.append(f"user {number}: {e}")
+    return {
+        "timings": timings,
+        "failures": failures,
+        "started_at": started_at,
+        "finished_at": time.time(),
+        "sessions": len(sessions),
+        "session_bytes": rss_bytes() - baseline_rss,
+        "uploads": resources.get_imagekit().uploads
+    }
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def summarize(timings, users, failures, elapsed, memory_per_session, uploads, args):
+    steps = {}
+    for step in STEPS:
+        samples = timings[step]
+        if samples:
+            steps[step] = {
+                "count": len(samples),
+                "mean_ms": statistics.mean(samples) * 1000,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": max(samples) * 1000
+            }
+    completed = users - len(failures)
+    total_steps = sum(len(samples) for samples in timings.values())
+    return {
+        "users": users,
+        "concurrency": args.concurrency,
+        "completed_users": completed,
+        "failures": failures,
+        "elapsed_s": elapsed,
+        "users_per_s": completed / elapsed if elapsed else 0.0,
+        "steps_per_s": total_steps / elapsed if elapsed else 0.0,
+        "memory_per_session_kb": memory_per_session / 1024,
+        "image_uploads": uploads,
+        "steps": steps
+    }
+
+
+def print_report(report):
+    print(
+        f"{report['completed_users']}/{report['users']} users in {report['elapsed_s']:.1f}s "
+        f"(concurrency {report['concurrency']}): {report['users_per_s']:.2f} users/s, "
+        f"{report['steps_per_s']:.2f} steps/s"
+    )
+    print(f"memory per session: {report['memory_per_session_kb']:.0f} KiB, image uploads: {report['image_uploads']}")
+    print(f"{'step':>15} {'n':>5} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for step, values in report["steps"].items():
+        print(
+            f"{step:>15} {values['count']:>5} {values['mean_ms']:>9.1f} {values['p50_ms']:>9.1f} "
+            f"{values['p95_ms']:>9.1f} {values['p99_ms']:>9.1f} {values['max_ms']:>9.1f}"
+        )
+    for failure in report["failures"]:
+        print(f"failed: {failure}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline multi-user load test for app.py")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--follow-ups", type=int, default=MAX_FOLLOW_UPS, help=f"At most {MAX_FOLLOW_UPS}, the app's limit")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Stub time to first token")
+    parser.add_argument("--token-ms", type=float, default=5, help="Stub delay between streamed tokens")
+    parser.add_argument("--completion-tokens", type=int, default=250)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stub requests that return 500")
+    parser.add_argument("--upload-ms", type=float, default=150, help="Fake ImageKit upload latency")
+    parser.add_argument("--mongo-uri", help="Use this (local) mongod instead of mongomock")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-script-run timeout in seconds")
+    parser.add_argument("--json", metavar="PATH", help="Also write the report as JSON (the app itself prints to stdout)")
+    args = parser.parse_args()
+    if args.follow_ups > MAX_FOLLOW_UPS:
+        print(f"--follow-ups {args.follow_ups} is over the app's limit; using {MAX_FOLLOW_UPS}")
+        args.follow_ups = MAX_FOLLOW_UPS
+    # Distinct phone numbers per run, so a persistent --mongo-uri database can be reused
+    args.run_id = int(time.time()) % 10000
+
+    server = start_stub_openai(args.ttft_ms, args.token_ms, args.completion_tokens, args.error_rate)
+    host, port = server.server_address
+    openai_url = f"http://{host}:{port}/v1"
+
+    workers = max(1, min(args.concurrency, args.users))
+    shares = [list(range(args.users))[i::workers] for i in range(workers)]
+    # spawn: the parent already runs the stub server's threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = list(pool.map(run_worker, shares, [args] * workers, [openai_url] * workers))
+    server.shutdown()
+
+    timings = {step: [sample for result in results for sample in result["timings"][step]] for step in STEPS}
+    failures = [failure for result in results for failure in result["failures"]]
+    elapsed = max(result["finished_at"] for result in results) - min(result["started_at"] for result in results)
+    sessions = sum(result["sessions"] for result in results)
+    memory_per_session = sum(result["session_bytes"] for result in results) / max(1, sessions)
+    uploads = sum(result["uploads"] for result in results)
+
+    report = summarize(timings, args.users, failures, elapsed, memory_per_session, uploads, args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# benchmarks/bench_startup.py
+"""Cold-start and per-rerun script execution time for app.py.
+
+Drives the real script with streamlit.testing's AppTest. Cold start is
+measured in a fresh interpreter per sample (imports, client registry,
+index creation); reruns reuse one process, which is what Streamlit does on
+every widget interaction.
+
+    python benchmarks/bench_startup.py [--cold 3] [--reruns 20] [--fake]
+
+--fake registers mongomock and inert OpenAI/ImageKit stand-ins so no
+network is needed (pip install mongomock).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def install_fakes():
+    import mongomock
+
+    import resources
+    resources.override_resource("mongo", mongomock.MongoClient())
+    # Plain reruns never call these; they only need to exist
+    resources.override_resource("openai", object())
+    resources.override_resource("imagekit", object())
+
+
+def make_app_test(authenticated):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    if authenticated:
+        at.session_state["authenticated"] = True
+        at.session_state["username"] = "9999999999"
+        at.session_state["user_id"] = "0" * 24
+    return at
+
+
+def run_once(fake, authenticated):
+    """Time the first script run in this interpreter"""
+    start = time.perf_counter()
+    if fake:
+        install_fakes()
+    at = make_app_test(authenticated)
+    at.run()
+    elapsed = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(at.exception)
+    return elapsed
+
+
+def cold_start_samples(count, fake, authenticated):
+    samples = []
+    for _ in range(count):
+        args = [sys.executable, __file__, "--child"]
+        if fake:
+            args.append("--fake")
+        if authenticated:
+            args.append("--authenticated")
+        output = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1])["seconds"])
+    return samples
+
+
+def rerun_samples(count, fake, authenticated):
+    if fake:
+        install_fakes()
+    at = make_app_test(authenticated)
+    at.run()
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        at.run()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def describe(name, samples):
+    print(
+        f"{name:>10}: median {statistics.median(samples) * 1000:8.1f} ms  "
+        f"min {min(samples) * 1000:8.1f} ms  max {max(samples) * 1000:8.1f} ms  (n={len(samples)})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py startup/rerun benchmark")
+    parser.add_argument("--cold", type=int, default=3)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--fake", action="store_true", help="Use local stand-ins instead of live services")
+    parser.add_argument("--anonymous", action="store_true", help="Benchmark the login page instead of the main page")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--authenticated", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps({"seconds": run_once(args.fake, args.authenticated)}))
+        return 0
+
+    authenticated = not args.anonymous
+    describe("cold start", cold_start_samples(args.cold, args.fake, authenticated))
+    describe("rerun", rerun_samples(args.reruns, args.fake, authenticated))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# cache_utils.py
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from db_utils import get_cached_answer, set_cached_answer
+from metrics_utils import record
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+CACHE_KEY_VERSION = "2"
+
+
+class LRUCache:
+    """Small thread-safe LRU with a per-entry TTL"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# One in-process tier shared by every Streamlit session of this server
+_local_cache = LRUCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+_stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "errors": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(stat, start):
+    """Count a lookup outcome here and in the metrics (answer_cache.<stat>) for the admin page"""
+    with _stats_lock:
+        _stats[stat] += 1
+    record(f"answer_cache.{stat}", (time.perf_counter() - start) * 1000, error=stat == "errors")
+
+
+def normalize_question_text(text):
+    """Collapse whitespace so trivial edits map to the same key.
+
+    Case is kept: Co and CO, or M and m, are different questions.
+    """
+    if not text:
+        return ""
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_cache_key(question_text, subject, question_type, image_bytes=None):
+    """Content-addressed key for a first-turn question"""
+    image_hash = hashlib.sha256(image_bytes).hexdigest() if image_bytes else ""
+    parts = [
+        # Bumped when normalisation changes, so old entries can't answer a different question
+        CACHE_KEY_VERSION,
+        normalize_question_text(question_text),
+        subject or "None",
+        question_type or "None",
+        image_hash
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_response(cache_key):
+    """Look up a formatted answer, first in-process and then in Mongo"""
+    start = time.perf_counter()
+    value = _local_cache.get(cache_key)
+    if value is not None:
+        _count("local_hits", start)
+        return value
+
+    try:
+        document = get_cached_answer(cache_key)
+    except Exception as e:
+        # The shared tier is an optimisation, never a reason to fail a question
+        print(f"Answer cache lookup failed: {e}")
+        _count("errors", start)
+        document = None
+
+    if document is None:
+        _count("misses", start)
+        return None
+
+    value = {"content": document["content"], "token_usage": document.get("token_usage")}
+    _local_cache.set(cache_key, value)
+    _count("shared_hits", start)
+    return value
+
+
+def cache_response(cache_key, content, token_usage=None):
+    """Store a formatted answer in both tiers"""
+    start = time.perf_counter()
+    value = {"content": content, "token_usage": token_usage}
+    _local_cache.set(cache_key, value)
+    try:
+        set_cached_answer(cache_key, content, token_usage, ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+    except Exception as e:
+        print(f"Answer cache store failed: {e}")
+        _count("errors", start)
+
+
+def cache_stats():
+    """Hit/miss counters for this process plus the current local tier size"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["local_entries"] = len(_local_cache)
+    lookups = stats["local_hits"] + stats["shared_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["local_hits"] + stats["shared_hits"]) / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,99 @@
+# context_utils.py
+import math
+import os
+import re
+
+from image_utils import estimate_image_tokens
+
+# Prompt budget for the conversation sent with each follow-up
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Per-message framing tokens the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Image size assumed when estimating, since only the URL is kept in the message
+ASSUMED_IMAGE_SIZE = (768, 1024)
+
+IMAGE_REFERENCE_TEXT = "[Image from the earlier question, already analysed in the solution above]"
+
+_FINAL_ANSWER_RE = re.compile(r"\*\*Final Answer:?\*\*:?(.*)", re.DOTALL)
+
+
+def estimate_text_tokens(text):
+    """Rough local token count (about four characters per token for English and LaTeX)"""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def estimate_message_tokens(message):
+    content = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(content)
+
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content:
+        if part["type"] == "text":
+            tokens += estimate_text_tokens(part["text"])
+        elif part["type"] == "image_url":
+            tokens += estimate_image_tokens(*ASSUMED_IMAGE_SIZE, part["image_url"].get("detail", "auto"))
+    return tokens
+
+
+def estimate_prompt_tokens(messages):
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def _collapse_images(message):
+    """Replace image parts the model has already answered with a short text reference"""
+    if isinstance(message["content"], str):
+        return message
+    content = [
+        {"type": "text", "text": IMAGE_REFERENCE_TEXT} if part["type"] == "image_url" else part
+        for part in message["content"]
+    ]
+    return {**message, "content": content}
+
+
+def summarize_solution(content):
+    """Shrink an earlier solution to its final answer, which is what follow-ups refer back to"""
+    match = _FINAL_ANSWER_RE.search(content)
+    if match and match.group(1).strip():
+        return f"(Earlier solution, summarised) **Final Answer:** {match.group(1).strip()}"
+    return f"(Earlier solution, summarised) {content[:300].strip()}..."
+
+
+def build_context(messages, budget=CONTEXT_TOKEN_BUDGET):
+    """Trim the conversation sent to the model to fit a prompt token budget.
+
+    The system message and the newest user message are always sent as-is.
+    Images the model has already answered become text references; if the
+    thread is still over budget, older solutions are summarised oldest first,
+    and as a last resort the oldest turns are dropped.
+
+    Returns the messages to send and a dict of estimated token savings.
+    """
+    before = estimate_prompt_tokens(messages)
+    if len(messages) <= 2:
+        return messages, {"estimated_prompt_tokens": before, "prompt_tokens_saved": 0}
+
+    system_message, history, latest = messages[0], list(messages[1:-1]), messages[-1]
+
+    # Everything before the latest user message has had a response already
+    history = [_collapse_images(message) if message["role"] == "user" else message for message in history]
+
+    def total():
+        return (
+            estimate_message_tokens(system_message)
+            + estimate_prompt_tokens(history)
+            + estimate_message_tokens(latest)
+        )
+
+    for i, message in enumerate(history):
+        if total() <= budget:
+            break
+        if message["role"] == "assistant":
+            history[i] = {**message, "content": summarize_solution(message["content"])}
+
+    while history and total() > budget:
+        history.pop(0)
+
+    trimmed = [system_message] + history + [latest]
+    after = estimate_prompt_tokens(trimmed)
+    return trimmed, {"estimated_prompt_tokens": after, "prompt_tokens_saved": before - after}
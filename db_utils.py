@@ -1,58 +1,473 @@
 # db_utils.py
+import atexit
 import os
+import queue
+import threading
+import time
 import pymongo
-from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
+from resources import get_mongo_client
+from metrics_utils import timed
 
-load_dotenv()
-client = pymongo.MongoClient(os.getenv("MONGODB_URI"))
-db = client["doubt_solver_app"]
+client = get_mongo_client()
+db = client[os.getenv("MONGODB_DB", "doubt_solver_app")]
 
 # Access specific collections
 users_collection = db["users"]
 questions_collection = db["questions"]
 feedback_collection = db["feedback"]
+answer_cache_collection = db["answer_cache"]
+images_collection = db["images"]
+metrics_collection = db["metrics"]
 
+# Optional write-behind mode: writes are queued and applied by a background
+# worker so the user's turn doesn't wait on Mongo round trips
+WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "false").lower() == "true"
+WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "1000"))
+WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+# Attempts per collection when a whole batch fails (e.g. a dropped connection)
+WRITE_RETRIES = int(os.getenv("DB_WRITE_RETRIES", "3"))
+
+# Questions per page in a user's history, and how much of each question's text is sent
+QUESTION_PAGE_SIZE = int(os.getenv("QUESTION_PAGE_SIZE", "20"))
+QUESTION_PREVIEW_CHARS = 160
+
+_write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+# Queued writes per question id and per "user:<id>", so a read waits only for its own writes
+_pending_writes = {}
+_pending_changed = threading.Condition()
+
+def _drop_redundant_question_index():
+    # The (user_id, timestamp) index the keyset one replaces is a redundant prefix
+    if "user_id_1_timestamp_-1" in questions_collection.index_information():
+        questions_collection.drop_index("user_id_1_timestamp_-1")
+
+def ensure_indexes():
+    """Create the indexes the queries below rely on; safe to call repeatedly.
+
+    Each index is attempted on its own, so one that can't be built (e.g.
+    duplicate usernames blocking the unique index) doesn't leave the rest
+    missing. Only a lost connection stops the remaining attempts.
+    """
+    steps = [
+        ("users.username", lambda: users_collection.create_index("username", unique=True)),
+        # _id breaks timestamp ties, so (timestamp, _id) keyset pages are served straight from the index
+        ("questions.user_id_timestamp_id", lambda: questions_collection.create_index([
+            ("user_id", pymongo.ASCENDING),
+            ("timestamp", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ])),
+        ("questions.user_id_timestamp (drop)", _drop_redundant_question_index),
+        # For catching the similarity index up on questions newer than its snapshot
+        ("questions.timestamp", lambda: questions_collection.create_index("timestamp")),
+        ("feedback.question_id", lambda: feedback_collection.create_index("question_id")),
+        # Let Mongo expire cached answers on their own once expires_at has passed
+        ("answer_cache.expires_at", lambda: answer_cache_collection.create_index("expires_at", expireAfterSeconds=0)),
+        ("metrics.window_start_operation", lambda: metrics_collection.create_index(
+            [("window_start", pymongo.DESCENDING), ("operation", pymongo.ASCENDING)]
+        ))
+    ]
+    for name, step in steps:
+        try:
+            step()
+        except ConnectionFailure:
+            raise
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create MongoDB index {name}: {e}")
+
+@timed("db.login")
 def login(username, password):
     user = users_collection.find_one({"username": username, "password": password})
     if user:
         return str(user["_id"])  # Return ObjectId as a string
     return None
 
+@timed("db.add_user")
 def add_user(username, password_hash):
-    users_collection.insert_one({"username": username, "password_hash": password_hash})
+    """Create a user; False if the username is already taken"""
+    try:
+        users_collection.insert_one({"username": username, "password_hash": password_hash})
+    except DuplicateKeyError:
+        # Lost a race with another signup for the same name
+        return False
+    return True
 
+@timed("db.set_password_hash")
+def set_password_hash(username, password_hash):
+    users_collection.update_one({"username": username}, {"$set": {"password_hash": password_hash}})
+
+@timed("db.get_user")
 def get_user(username):
-    return users_collection.find_one({"username": username})
+    return users_collection.find_one({"username": username}, {"password_hash": 1})
 
+@timed("db.count_user_messages")
 def count_user_messages(question_id):
     """Count the number of user messages for a specific question"""
-    question = questions_collection.find_one({"_id": ObjectId(question_id)})
-    if not question or "messages" not in question:
+    flush_writes(question_id)
+    question = questions_collection.find_one(
+        {"_id": ObjectId(question_id)},
+        {"user_message_count": 1}
+    )
+    if not question:
         return 0
-    
-    # Count messages where role is "user"
-    user_messages = sum(1 for msg in question["messages"] if msg["role"] == "user")
+    if "user_message_count" in question:
+        return question["user_message_count"]
+
+    # Older documents predate the counter: count on the server, then backfill it
+    result = list(questions_collection.aggregate([
+        {"$match": {"_id": ObjectId(question_id)}},
+        {"$project": {"count": {"$size": {"$filter": {
+            "input": {"$ifNull": ["$messages", []]},
+            "as": "message",
+            "cond": {"$eq": ["$$message.role", "user"]}
+        }}}}}
+    ]))
+    user_messages = result[0]["count"] if result else 0
+    questions_collection.update_one(
+        {"_id": ObjectId(question_id), "user_message_count": {"$exists": False}},
+        {"$set": {"user_message_count": user_messages}}
+    )
     return user_messages
 
+@timed("db.get_question")
 def get_question(question_id):
     """Retrieve a question document by its ID"""
+    flush_writes(question_id)
     return questions_collection.find_one({"_id": ObjectId(question_id)})
 
+def encode_cursor(timestamp, question_id):
+    return f"{timestamp.isoformat()}|{question_id}"
+
+def _decode_cursor(cursor):
+    timestamp, question_id = cursor.split("|")
+    return datetime.fromisoformat(timestamp), ObjectId(question_id)
+
+@timed("db.list_user_questions")
+def list_user_questions(user_id, cursor=None, page_size=QUESTION_PAGE_SIZE):
+    """One page of a user's questions, newest first, as (questions, next_cursor).
+
+    Pages are keyset-paginated on (timestamp, _id): cursor is the opaque
+    next_cursor of the previous page, and None at the end. Only a preview of
+    each question is returned; use get_question_thread for the messages.
+    """
+    flush_writes(user_id=user_id)
+    match = {"user_id": ObjectId(user_id)}
+    if cursor:
+        timestamp, question_id = _decode_cursor(cursor)
+        match["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": question_id}}
+        ]
+    documents = list(questions_collection.aggregate([
+        {"$match": match},
+        {"$sort": {"timestamp": -1, "_id": -1}},
+        # One extra row tells us whether there is a next page
+        {"$limit": page_size + 1},
+        {"$project": {
+            "_id": 1,
+            "timestamp": 1,
+            "subject": 1,
+            "question_type": 1,
+            "has_image": {"$gt": ["$image_base64", None]},
+            "preview": {"$substrCP": [{"$ifNull": ["$question_text", ""]}, 0, QUESTION_PREVIEW_CHARS]},
+            # Older documents predate the counter; count their user turns server-side
+            "turns": {"$subtract": [
+                {"$ifNull": ["$user_message_count", {"$size": {"$filter": {
+                    "input": {"$ifNull": ["$messages", []]},
+                    "cond": {"$eq": ["$$this.role", "user"]}
+                }}}]},
+                # add_question seeds the opening question, then the app adds it again as the first turn
+                {"$cond": [{"$and": [
+                    {"$eq": [{"$arrayElemAt": ["$messages.role", 0]}, "user"]},
+                    {"$eq": [{"$arrayElemAt": ["$messages.role", 1]}, "user"]}
+                ]}, 1, 0]}
+            ]}
+        }}
+    ]))
+    next_cursor = None
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        next_cursor = encode_cursor(documents[-1]["timestamp"], documents[-1]["_id"])
+    questions = [
+        {
+            "question_id": str(document["_id"]),
+            "timestamp": document["timestamp"],
+            "subject": document.get("subject"),
+            "question_type": document.get("question_type"),
+            "has_image": bool(document.get("has_image")),
+            "first_line": document["preview"].strip().split("\n")[0],
+            "turns": document["turns"]
+        }
+        for document in documents
+    ]
+    return questions, next_cursor
+
+@timed("db.get_question_thread")
+def get_question_thread(question_id, user_id):
+    """Messages of one of this user's questions, or None if it isn't theirs"""
+    flush_writes(question_id)
+    document = questions_collection.find_one(
+        {"_id": ObjectId(question_id), "user_id": ObjectId(user_id)},
+        {"messages": 1, "image_base64": 1}
+    )
+    if document is None:
+        return None
+    return {"image_url": document.get("image_base64"), "messages": document.get("messages", [])}
+
+def _bulk_write(collection_name, ops):
+    """Apply one collection's ops, logging (not dropping silently) any that fail.
+
+    Only questions need ordering (a push must land after its insert); there
+    a failed op is logged and the ops after it are resumed. Other
+    collections are written unordered. A batch lost to a connection error is
+    retried; part of it may already have been applied, so a retried insert
+    that hits its own _id is skipped and pushes are guarded by write_id.
+    """
+    ordered = collection_name == questions_collection.name
+    attempt = 0
+    while ops:
+        try:
+            db[collection_name].bulk_write(ops, ordered=ordered)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            for error in errors:
+                if attempt and error.get("code") == 11000:
+                    # Inserted by the attempt that lost its connection
+                    continue
+                print(f"Write-behind {collection_name} op failed: {error.get('errmsg')} ({ops[error['index']]})")
+            if not ordered or not errors:
+                return
+            ops = ops[errors[-1]["index"] + 1:]
+        except Exception as e:
+            attempt += 1
+            if not isinstance(e, ConnectionFailure) or attempt >= WRITE_RETRIES:
+                print(f"Write-behind dropped {len(ops)} {collection_name} op(s) after {attempt} attempts: {e}")
+                for op in ops:
+                    print(f"  dropped: {op}")
+                return
+            time.sleep(0.5 * 2 ** attempt)
+
+def _apply_writes(batch):
+    """Apply queued writes with one bulk_write per collection.
+
+    Pushes to the same question are coalesced into a single $push/$each at
+    the position of the first one, which keeps them after the question's insert.
+    The push only matches while its first message's write_id isn't stored
+    yet, so retrying it never duplicates messages or turn counts.
+    Each collection is written on its own, so a failure in one never costs
+    another its writes.
+    """
+    ops_by_collection = {}
+    pending_pushes = {}
+    for kind, collection_name, *args in batch:
+        ops = ops_by_collection.setdefault(collection_name, [])
+        if kind == "insert":
+            ops.append(pymongo.InsertOne(args[0]))
+        elif kind == "update":
+            update_filter, update, upsert = args
+            ops.append(pymongo.UpdateOne(update_filter, update, upsert=upsert))
+        elif kind == "push":
+            question_id, message_data, user_turns = args
+            pending = pending_pushes.get(question_id)
+            if pending is None:
+                pending = {"messages": [], "user_turns": 0, "index": len(ops)}
+                pending_pushes[question_id] = pending
+                ops.append(None)
+            pending["messages"].append(message_data)
+            pending["user_turns"] += user_turns
+
+    for question_id, pending in pending_pushes.items():
+        update = {"$push": {"messages": {"$each": pending["messages"]}}}
+        if pending["user_turns"]:
+            update["$inc"] = {"user_message_count": pending["user_turns"]}
+        ops_by_collection[questions_collection.name][pending["index"]] = pymongo.UpdateOne(
+            {"_id": question_id, "messages.write_id": {"$ne": pending["messages"][0]["write_id"]}}, update
+        )
+
+    for collection_name, ops in ops_by_collection.items():
+        try:
+            _bulk_write(collection_name, ops)
+        except Exception as e:
+            print(f"Write-behind {collection_name} batch of {len(ops)} failed: {e}")
+
+def _pending_keys(item):
+    """Keys a queued write makes reads wait on"""
+    kind, collection_name, *args = item
+    if collection_name != questions_collection.name:
+        return []
+    if kind == "insert":
+        return [str(args[0]["_id"]), f"user:{args[0]['user_id']}"]
+    if kind == "push":
+        return [str(args[0])]
+    question_id = args[0].get("_id")
+    return [str(question_id)] if question_id is not None else []
+
+def _finish_pending(batch):
+    with _pending_changed:
+        for item in batch:
+            for key in _pending_keys(item):
+                _pending_writes[key] -= 1
+                if not _pending_writes[key]:
+                    del _pending_writes[key]
+        _pending_changed.notify_all()
+
+def _write_worker():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _apply_writes(batch)
+        except Exception as e:
+            print(f"Write-behind batch of {len(batch)} failed: {e}")
+        finally:
+            _finish_pending(batch)
+            for _ in batch:
+                _write_queue.task_done()
+
+def _enqueue_write(item):
+    global _writer_thread
+    if _writer_thread is None:
+        with _writer_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_write_worker, name="db-write-behind", daemon=True)
+                _writer_thread.start()
+    with _pending_changed:
+        for key in _pending_keys(item):
+            _pending_writes[key] = _pending_writes.get(key, 0) + 1
+    # Blocks while the queue is full, which is the backpressure on callers
+    _write_queue.put(item)
+
+def flush_writes(question_id=None, user_id=None):
+    """Wait until queued writes have been applied: those to one question, to
+    one user's questions, or with neither given, every queued write"""
+    if _writer_thread is None:
+        return
+    if question_id is None and user_id is None:
+        _write_queue.join()
+        return
+    key = str(question_id) if question_id is not None else f"user:{user_id}"
+    with _pending_changed:
+        _pending_changed.wait_for(lambda: key not in _pending_writes)
+
+def write_queue_depth():
+    return _write_queue.qsize()
+
+def _insert(collection, document):
+    if WRITE_BEHIND:
+        _enqueue_write(("insert", collection.name, document))
+    else:
+        collection.insert_one(document)
+
+def _update(collection, update_filter, update, upsert=False):
+    if WRITE_BEHIND:
+        _enqueue_write(("update", collection.name, update_filter, update, upsert))
+    else:
+        collection.update_one(update_filter, update, upsert=upsert)
+
 # Modify the add_question function in db_utils.py
-def add_question(user_id, question_text, image_base64, subject, question_type):
-    question_id = questions_collection.insert_one({
+@timed("db.add_question")
+def add_question(user_id, question_text, image_base64, subject, question_type, question_id=None):
+    # The id is generated client-side so it can be returned before the insert lands
+    question_id = ObjectId(question_id) if question_id else ObjectId()
+    timestamp = datetime.now()
+    _insert(questions_collection, {
+        "_id": question_id,
         "user_id": ObjectId(user_id),
         "question_text": question_text,
         "image_base64": image_base64,
         "subject": subject,
         "question_type": question_type,
         "messages": [{"role": "user", "content": question_text}],
-        "timestamp": datetime.now()
-    }).inserted_id
+        "user_message_count": 1,
+        "timestamp": timestamp
+    })
+    # Imported here: similarity_utils reads questions back through this module
+    from similarity_utils import index_question
+    index_question(question_id, question_text, subject)
     return str(question_id)
 
+@timed("db.set_question_image")
+def set_question_image(question_id, image_url):
+    """Attach an image URL to a question saved before its upload finished"""
+    _update(questions_collection, {"_id": ObjectId(question_id)}, {"$set": {"image_base64": image_url}})
+
+def iter_questions_since(since=None):
+    """Text, subject and timestamp of questions from since onwards (all if None)"""
+    query = {"question_text": {"$nin": [None, ""]}}
+    if since:
+        query["timestamp"] = {"$gte": since}
+    return questions_collection.find(
+        query,
+        {"question_text": 1, "subject": 1, "timestamp": 1},
+        batch_size=1000
+    )
+
+@timed("db.get_solved_questions")
+def get_solved_questions(question_ids):
+    """{question_id: question} for those of these questions that have an answer"""
+    if not question_ids:
+        return {}
+    documents = questions_collection.find(
+        {"_id": {"$in": [ObjectId(question_id) for question_id in question_ids]}},
+        # Only the first answer is shown, so the rest of the thread stays in Mongo
+        {"question_text": 1, "subject": 1, "question_type": 1, "messages": {"$slice": 4}}
+    )
+    solved = {}
+    for document in documents:
+        answer = next((m for m in document.get("messages", []) if m["role"] == "assistant"), None)
+        if answer:
+            solved[str(document["_id"])] = {
+                "question_id": str(document["_id"]),
+                "question_text": document["question_text"],
+                "subject": document.get("subject"),
+                "question_type": document.get("question_type"),
+                "answer": answer["content"]
+            }
+    return solved
+
+@timed("db.add_solved_questions")
+def add_solved_questions(user_id, solved):
+    """Bulk-insert already answered questions and return their ids.
+
+    Each item has question_text, user_content (the message sent to the model),
+    image_url, subject, question_type, answer and token_usage.
+    """
+    documents = []
+    for item in solved:
+        timestamp = datetime.now()
+        user_message = {"role": "user", "content": item["user_content"], "timestamp": timestamp}
+        documents.append({
+            "_id": ObjectId(),
+            "user_id": ObjectId(user_id),
+            "question_text": item["question_text"],
+            "image_base64": item["image_url"],
+            "subject": item["subject"],
+            "question_type": item["question_type"],
+            "messages": [
+                user_message,
+                {"role": "assistant", "content": item["answer"], "timestamp": timestamp, "token_usage": item["token_usage"]}
+            ],
+            "user_message_count": 1,
+            "timestamp": timestamp
+        })
+    if documents:
+        questions_collection.insert_many(documents, ordered=False)
+    # Imported here: similarity_utils reads questions back through this module
+    from similarity_utils import index_question
+    for document in documents:
+        index_question(document["_id"], document["question_text"], document["subject"])
+    return [str(document["_id"]) for document in documents]
+
+@timed("db.add_message_to_question")
 def add_message_to_question(question_id, role, content, token_info=None):
     """Add a message to a question with optional token usage information"""
     message_data = {
@@ -64,17 +479,84 @@ def add_message_to_question(question_id, role, content, token_info=None):
     # Add token info if provided (for assistant messages)
     if token_info:
         message_data["token_usage"] = token_info
-        
-    questions_collection.update_one(
-        {"_id": ObjectId(question_id)},
-        {"$push": {"messages": message_data}}
-    )
 
+    user_turns = 1 if role == "user" else 0
+    if WRITE_BEHIND:
+        # Lets a retried batch see that this push already landed
+        message_data["write_id"] = ObjectId()
+        _enqueue_write(("push", questions_collection.name, ObjectId(question_id), message_data, user_turns))
+        return
+
+    update = {"$push": {"messages": message_data}}
+    if user_turns:
+        # Kept alongside the push so count_user_messages never reads message bodies
+        update["$inc"] = {"user_message_count": user_turns}
+    questions_collection.update_one({"_id": ObjectId(question_id)}, update)
+
+@timed("db.add_feedback")
 def add_feedback(user_id, question_id, feedback_text, rating):
-    feedback_collection.insert_one({
+    _insert(feedback_collection, {
         "user_id": ObjectId(user_id),
         "question_id": ObjectId(question_id),
         "feedback_text": feedback_text,
         "rating": rating,
         "timestamp": datetime.now()
     })
+
+@timed("db.get_cached_answer")
+def get_cached_answer(cache_key):
+    """Fetch a cached (already formatted) answer by its content hash"""
+    return answer_cache_collection.find_one(
+        {"_id": cache_key, "expires_at": {"$gt": datetime.now()}},
+        {"content": 1, "token_usage": 1}
+    )
+
+@timed("db.set_cached_answer")
+def set_cached_answer(cache_key, content, token_usage=None, ttl_seconds=7 * 24 * 3600):
+    """Store a formatted answer under its content hash, refreshing the TTL"""
+    now = datetime.now()
+    _update(
+        answer_cache_collection,
+        {"_id": cache_key},
+        {"$set": {
+            "content": content,
+            "token_usage": token_usage,
+            "timestamp": now,
+            "expires_at": now + timedelta(seconds=ttl_seconds)
+        }},
+        upsert=True
+    )
+
+@timed("db.get_image_record")
+def get_image_record(image_hash):
+    """Look up an uploaded image by the SHA-256 of its bytes"""
+    return images_collection.find_one({"_id": image_hash}, {"url": 1, "file_path": 1})
+
+@timed("db.save_image_record")
+def save_image_record(image_hash, url, file_path):
+    """Record hash -> URL; if another upload won the race, return its record instead"""
+    return images_collection.find_one_and_update(
+        {"_id": image_hash},
+        {"$setOnInsert": {"url": url, "file_path": file_path, "timestamp": datetime.now()}},
+        projection={"url": 1, "file_path": 1},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+
+def add_metrics(documents):
+    """Store flushed telemetry windows (see metrics_utils)"""
+    metrics_collection.insert_many(documents, ordered=False)
+
+def get_metrics(since):
+    """Telemetry windows that started at or after since"""
+    return list(metrics_collection.find({"window_start": {"$gte": since}}, {"_id": 0, "pid": 0}))
+
+# Apply anything still queued before the process exits
+atexit.register(flush_writes)
+
+# Streamlit imports this module once per process, so this runs once at startup
+try:
+    ensure_indexes()
+except pymongo.errors.PyMongoError as e:
+    print(f"Could not create MongoDB indexes: {e}")
@@ -0,0 +1,291 @@
+# image_utils.py
+import base64
+import contextvars
+import hashlib
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+
+from db_utils import add_message_to_question, add_question, get_image_record, save_image_record, set_question_image
+from metrics_utils import timed
+
+# Preprocessing knobs, tuned against answer quality
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "true").lower() == "true"
+# Pixels darker than this count as content when cropping away the paper margin
+IMAGE_CONTENT_THRESHOLD = int(os.getenv("IMAGE_CONTENT_THRESHOLD", "200"))
+IMAGE_CROP_PADDING = 16
+# A processed image whose darkest and lightest pixels are closer than this has lost the question
+IMAGE_MIN_CONTRAST = 8
+
+# Send the image to the model inline and upload it to ImageKit in the background
+IMAGE_INLINE_UPLOAD = os.getenv("IMAGE_INLINE_UPLOAD", "true").lower() == "true"
+IMAGE_UPLOAD_WORKERS = int(os.getenv("IMAGE_UPLOAD_WORKERS", "4"))
+
+# Vision detail per subject; override with e.g. VISION_DETAIL_BIOLOGY=high
+VISION_DETAIL = {
+    "None": "auto",
+    "Physics": "high",
+    "Chemistry": "high",
+    "Mathematics": "high",
+    "Biology": "low"
+}
+
+# (base tokens, tokens per 512px tile) charged per image, by model
+VISION_TOKEN_COSTS = {
+    "gpt-4o-mini": (2833, 5667),
+    "gpt-4o": (85, 170)
+}
+
+
+def image_sha256(image_bytes):
+    """Content address of an image, stable across restarts and users"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _imagekit_folder(subject):
+    return subject.lower() if subject and subject != "None" else "general"
+
+
+def _display_url(imagekit, file_path):
+    return imagekit.url({
+        "path": file_path,
+        "transformation": [{
+            "height": "300",
+            "width": "300"
+        }]
+    })
+
+
+def get_or_upload_image(imagekit, image_bytes, file_name, subject):
+    """Return the ImageKit URL for these bytes, uploading only if no user has sent them before"""
+    from imagekitio.models.UploadFileRequestOptions import UploadFileRequestOptions
+
+    image_hash = image_sha256(image_bytes)
+    record = get_image_record(image_hash)
+    if record:
+        return record["url"]
+
+    # Upload straight from memory; the SDK streams BufferedReader objects as a file part
+    upload_response = imagekit.upload_file(
+        file=io.BufferedReader(io.BytesIO(image_bytes)),
+        file_name=file_name,
+        options=UploadFileRequestOptions(
+            folder=f"/{_imagekit_folder(subject)}",
+            is_private_file=False,
+            use_unique_file_name=True,
+            response_fields=["is_private_file", "tags"],
+            tags=[_imagekit_folder(subject)]
+        )
+    )
+    image_url = _display_url(imagekit, upload_response.file_path)
+    record = save_image_record(image_hash, image_url, upload_response.file_path)
+    return record["url"]
+
+
+_upload_pool = None
+
+
+def _get_upload_pool():
+    global _upload_pool
+    if _upload_pool is None:
+        _upload_pool = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS, thread_name_prefix="image-upload")
+    return _upload_pool
+
+
+def _submit(fn, *args):
+    # Carry the caller's metric labels over to the worker thread
+    return _get_upload_pool().submit(contextvars.copy_context().run, fn, *args)
+
+
+def data_url(image_bytes):
+    """Inline data URL for the model, so it doesn't have to fetch the image from ImageKit"""
+    mime = "image/png" if image_bytes.startswith(b"\x89PNG") else "image/jpeg"
+    return f"data:{mime};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+
+
+@timed("upload_image_to_imagekit", none_is_error=True)
+def _upload_or_none(imagekit, image_bytes, file_name, subject):
+    try:
+        return get_or_upload_image(imagekit, image_bytes, file_name, subject)
+    except Exception as e:
+        # No page to report to from a worker thread; the question is saved without a URL
+        print(f"Error uploading image in the background: {e}")
+        return None
+
+
+def start_upload(imagekit, image_bytes, file_name, subject):
+    """Upload on a worker thread; returns a Future of the URL (None on failure)"""
+    return _submit(_upload_or_none, imagekit, image_bytes, file_name, subject)
+
+
+def _save_image_question(question_id, question, upload, content):
+    user_id, question_text, subject, question_type = question
+    add_question(user_id, question_text, None, subject, question_type, question_id=question_id)
+    image_url = upload.result()
+    if image_url:
+        set_question_image(question_id, image_url)
+    # The thread stores the ImageKit URL, never the inline bytes
+    stored = [
+        {**part, "image_url": {**part["image_url"], "url": image_url}} if part["type"] == "image_url" else part
+        for part in content
+        if part["type"] != "image_url" or image_url
+    ]
+    add_message_to_question(question_id, "user", stored)
+    return image_url
+
+
+def save_image_question(user_id, question_text, subject, question_type, upload, content):
+    """Insert an image question and its first turn on a worker thread.
+
+    The question is saved straight away without an image; once upload
+    finishes its URL is set and the user turn is appended with it. Returns
+    (question_id, Future of the URL): wait for the future before adding
+    later messages so the thread stays in order.
+    """
+    question_id = str(ObjectId())
+    question = (user_id, question_text, subject, question_type)
+    return question_id, _submit(_save_image_question, question_id, question, upload, content)
+
+
+def vision_detail(subject):
+    """Vision detail level to request for this subject"""
+    subject = subject or "None"
+    override = os.getenv(f"VISION_DETAIL_{subject.upper()}")
+    return override or VISION_DETAIL.get(subject, "auto")
+
+
+def _vision_size(width, height):
+    """Size the model actually looks at: fit in 2048x2048, then shortest side at most 768"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return width * scale, height * scale
+
+
+def _vision_tiles(width, height):
+    width, height = _vision_size(width, height)
+    return math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_image_tokens(width, height, detail, model="gpt-4o-mini"):
+    """Prompt tokens the model charges for one image, following OpenAI's tiling rules"""
+    base, per_tile = VISION_TOKEN_COSTS.get(model, VISION_TOKEN_COSTS["gpt-4o"])
+    if detail == "low":
+        return base
+    # "high" and "auto" are billed as high for anything larger than a thumbnail
+    return base + per_tile * _vision_tiles(width, height)
+
+
+def _crop_to_content(image):
+    """Crop to the bounding box of dark (ink) pixels, keeping a small margin"""
+    grayscale = image if image.mode == "L" else image.convert("L")
+    mask = grayscale.point(lambda value: 255 if value < IMAGE_CONTENT_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(0, left - IMAGE_CROP_PADDING),
+        max(0, top - IMAGE_CROP_PADDING),
+        min(image.width, right + IMAGE_CROP_PADDING),
+        min(image.height, bottom + IMAGE_CROP_PADDING)
+    ))
+
+
+def _to_8bit(image):
+    """Stretch 16-bit and 32-bit grayscale to 8-bit; converting them directly clips everything to white"""
+    image = image.convert("F")
+    low, high = image.getextrema()
+    scale = 255 / (high - low) if high > low else 0
+    return image.point(lambda value: (value - low) * scale).convert("L")
+
+
+def _flatten(image):
+    """Drop the alpha channel onto white paper; converting directly leaves transparent pixels black"""
+    from PIL import Image
+
+    image = image.convert("RGBA")
+    return Image.alpha_composite(Image.new("RGBA", image.size, "white"), image).convert("RGB")
+
+
+def _has_contrast(image):
+    grayscale = image if image.mode == "L" else image.convert("L")
+    low, high = grayscale.getextrema()
+    return high - low >= IMAGE_MIN_CONTRAST
+
+
+def unprocessed_image(image_bytes, size=None):
+    """The upload as-is, for images preprocessing can't read or would ruin"""
+    return {
+        "bytes": image_bytes,
+        "original_size": size,
+        "size": size,
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(image_bytes)
+    }
+
+
+def preprocess_image(image_bytes):
+    """Orient, grayscale, crop, downscale and re-encode a question photo.
+
+    Returns a dict with the bytes to upload and send plus the original and
+    processed dimensions/sizes used by preprocessing_report.
+    """
+    # Pillow is only needed once an image actually arrives
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(image_bytes))
+    original_size = image.size
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("I", "F") or image.mode.startswith("I;"):
+        image = _to_8bit(image)
+    elif image.mode in ("RGBA", "LA", "PA", "La", "RGBa") or "transparency" in image.info:
+        image = _flatten(image)
+    image = image.convert("L") if IMAGE_GRAYSCALE else image.convert("RGB")
+    tile_budget = _vision_tiles(*image.size)
+    image = _crop_to_content(image)
+
+    # Anything beyond what the model looks at is wasted bytes
+    target = [round(side) for side in _vision_size(*image.size)]
+    target = [min(side, IMAGE_MAX_EDGE) for side in target]
+    # A tight crop of a wide strip can cost more tiles than the whole photo did
+    while _vision_tiles(*target) > tile_budget and min(target) > 64:
+        target = [round(side * 0.9) for side in target]
+    if tuple(target) != image.size:
+        image.thumbnail(tuple(target), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    processed_bytes = buffer.getvalue()
+
+    # Never make things worse: keep the original if the result is blank or re-encoding didn't help
+    if not _has_contrast(image) or len(processed_bytes) >= len(image_bytes):
+        return unprocessed_image(image_bytes, original_size)
+    return {
+        "bytes": processed_bytes,
+        "original_size": original_size,
+        "size": image.size,
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(processed_bytes)
+    }
+
+
+def preprocessing_report(prepared, detail, model="gpt-4o-mini"):
+    """Bytes and prompt tokens saved compared to sending the raw photo at default detail"""
+    if prepared["size"] is None:
+        return None
+    tokens_before = estimate_image_tokens(*prepared["original_size"], "auto", model)
+    tokens_after = estimate_image_tokens(*prepared["size"], detail, model)
+    return {
+        "detail": detail,
+        "original_bytes": prepared["original_bytes"],
+        "processed_bytes": prepared["processed_bytes"],
+        "bytes_saved": prepared["original_bytes"] - prepared["processed_bytes"],
+        "estimated_image_tokens": tokens_after,
+        "prompt_tokens_saved": tokens_before - tokens_after
+    }
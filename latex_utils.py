@@ -0,0 +1,255 @@
+# latex_utils.py
+import re
+import time
+
+
+# Commands that the model often writes without their backslash. Order matters:
+# it is the priority the original one-regex-per-command passes applied them in.
+LATEX_COMMANDS = (
+    'alpha', 'beta', 'gamma', 'delta', 'pi', 'theta',
+    'mu', 'quad', 'text', 'mod', 'div'
+)
+
+# Characters str.splitlines() breaks on besides '\n'; rare in model output,
+# so they take the slow line-by-line path instead of the compiled one
+_EXOTIC_LINE_BREAKS = re.compile('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_DISPLAY_LINE_RE = re.compile(r'^[^\S\n]*(\$\$(?:\$|[^\n]*\$\$)?)[^\S\n]*$', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_INLINE_MATH_RE = re.compile(r'(?<!\$)\$(?!\$)([^\$]+?)\$(?!\$)')
+_SPACES_RE = re.compile(r' +')
+_INLINE_DELIMITER_RE = re.compile(r'\\[()]')
+_DISPLAY_DELIMITER_RE = re.compile(r'\\[\[\]]')
+
+
+def _command_alternation(commands):
+    # Longest first so a command is never shadowed by one of its prefixes
+    names = sorted(commands, key=len, reverse=True)
+    return '|'.join(re.escape(name) for name in names)
+
+
+def _overlap_junctions(commands):
+    """Strings where two command matches overlap, e.g. "modiv" or "textheta".
+
+    Only these make the order of the per-command passes observable; text
+    without them can escape every command in one substitution.
+    """
+    junctions = set()
+    for first in commands:
+        for second in commands:
+            if first != second and second in first:
+                junctions.add(first)
+            for k in range(1, min(len(first), len(second))):
+                if first.endswith(second[:k]):
+                    junctions.add(first + second[k:])
+    return junctions
+
+
+_COMMAND_RE = re.compile(r'(?<!\\)(?:' + _command_alternation(LATEX_COMMANDS) + ')')
+# Zero-width lookahead so overlapping command starts are all reported
+_COMMAND_START_RE = re.compile(r'(?<!\\)(?=(' + _command_alternation(LATEX_COMMANDS) + '))')
+_OVERLAP_RE = re.compile(_command_alternation(_overlap_junctions(LATEX_COMMANDS)) or r'(?!)')
+_PRIORITY = {name: i for i, name in enumerate(LATEX_COMMANDS)}
+# Shorter commands that start wherever a longer one does ("mod" in "modulus")
+_PREFIXES = {
+    name: [other for other in LATEX_COMMANDS if other != name and name.startswith(other)]
+    for name in LATEX_COMMANDS
+}
+
+
+def _resolve_commands(text):
+    """Escape commands exactly as the original one-pass-per-command loop did.
+
+    Each pass escaped its command left to right, skipping overlaps with its own
+    previous match, and could not match across (or right after) a backslash
+    inserted by an earlier pass.
+    """
+    by_command = {}
+    for match in _COMMAND_START_RE.finditer(text):
+        start = match.start()
+        name = match.group(1)
+        by_command.setdefault(name, []).append(start)
+        for prefix in _PREFIXES[name]:
+            by_command.setdefault(prefix, []).append(start)
+
+    escaped = bytearray(len(text) + 1)
+    for name in sorted(by_command, key=_PRIORITY.__getitem__):
+        length = len(name)
+        last_end = -1
+        for start in by_command[name]:
+            if start < last_end or escaped.find(1, start, start + length) != -1:
+                continue
+            escaped[start] = 1
+            last_end = start + length
+
+    parts = []
+    pos = 0
+    start = escaped.find(1)
+    while start != -1:
+        parts.append(text[pos:start])
+        parts.append('\\')
+        pos = start
+        start = escaped.find(1, start + 1)
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _fix_delimiters_and_commands(response):
+    """Steps 1 and 2 with one compiled pass per delimiter kind and one for all commands"""
+    if '\\' in response:
+        response = _INLINE_DELIMITER_RE.sub('$', response)
+        response = _DISPLAY_DELIMITER_RE.sub('$$', response)
+    # Delimiters never touch letters, so command matches are the same before or after
+    if _OVERLAP_RE.search(response):
+        return _resolve_commands(response)
+    return _COMMAND_RE.sub(r'\\\g<0>', response)
+
+
+def _isolate_display_lines(response):
+    """Step 3: put blank lines around lines holding only a display equation"""
+    if _EXOTIC_LINE_BREAKS.search(response):
+        formatted_lines = []
+        for line in response.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('$$') and stripped.endswith('$$'):
+                formatted_lines.extend(['', stripped, ''])
+            else:
+                formatted_lines.append(line)
+        return '\n'.join(formatted_lines)
+    if '$$' not in response:
+        return response
+    return _DISPLAY_LINE_RE.sub('\n\\1\n', response)
+
+
+def format_latex_response(response):
+    if response is None:
+        return ""
+
+    # Steps 1-2: fix \( \) \[ \] delimiters and bare LaTeX commands
+    response = _fix_delimiters_and_commands(response)
+
+    # Step 3: Handle display equations
+    response = _isolate_display_lines(response)
+
+    # Step 4: Clean up spacing
+    # Remove multiple blank lines
+    if '\n\n\n' in response:
+        response = _BLANK_LINES_RE.sub('\n\n', response)
+    # Fix spacing around inline equations
+    if '$' in response:
+        response = _INLINE_MATH_RE.sub(r' $\1$ ', response)
+    # Remove extra spaces
+    response = _SPACES_RE.sub(' ', response)
+
+    return response.strip()
+
+
+# Tokens that open/close math; used to find paragraph breaks that are safe to format
+_MATH_TOKEN_RE = re.compile(r'\$\$|\\\[|\\\]|\$|\\\(|\\\)')
+_PARAGRAPH_BREAK = '\n\n'
+# A display block still open after this many more paragraphs is taken to be a stray delimiter
+_MAX_OPEN_DISPLAY_PARAGRAPHS = 3
+
+
+def _can_freeze(head):
+    """True if head can be formatted on its own.
+
+    Inline math never spans a blank line, so an unmatched $ only affects its
+    own paragraph. Display math can, so a head with a display block still
+    open can't freeze, unless it was opened long enough ago to be a stray.
+    """
+    open_display = False
+    open_for = 0
+    for paragraph in head.split(_PARAGRAPH_BREAK):
+        display = sum(1 for token in _MATH_TOKEN_RE.findall(paragraph) if token in ('$$', r'\[', r'\]'))
+        if display % 2:
+            open_display = not open_display
+            open_for = 0
+        elif open_display:
+            open_for += 1
+    return not open_display or open_for >= _MAX_OPEN_DISPLAY_PARAGRAPHS
+
+
+class IncrementalLatexFormatter:
+    """Formats a streamed response for display as chunks arrive.
+
+    Completed paragraphs are formatted once and frozen; only the still-open
+    tail is re-formatted, and only when render() is called. Split delimiters
+    or commands (``\\`` then ``(``, ``alp`` then ``ha``) always sit in the
+    tail, so they are fixed once the rest of the token arrives. The display
+    text is a preview only: ``finish()`` runs ``format_latex_response`` once
+    over the whole response so what gets persisted matches non-streaming mode
+    exactly.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._frozen = ''
+        self._tail = ''
+
+    def append(self, chunk):
+        """Add a chunk without formatting anything but newly completed paragraphs"""
+        if chunk:
+            self._chunks.append(chunk)
+            self._tail += chunk
+            # Only a new paragraph break can make more of the tail freezable
+            if _PARAGRAPH_BREAK in self._tail[-(len(chunk) + 1):]:
+                self._freeze_complete_paragraphs()
+
+    def feed(self, chunk):
+        """Add a chunk and return the text to display so far"""
+        self.append(chunk)
+        return self.render()
+
+    def _freeze_complete_paragraphs(self):
+        boundary = self._tail.rfind(_PARAGRAPH_BREAK)
+        while boundary > 0:
+            head = self._tail[:boundary]
+            if _can_freeze(head):
+                formatted = format_latex_response(head)
+                if formatted:
+                    self._frozen = f'{self._frozen}\n\n{formatted}' if self._frozen else formatted
+                self._tail = self._tail[boundary + len(_PARAGRAPH_BREAK):]
+                return
+            boundary = self._tail.rfind(_PARAGRAPH_BREAK, 0, boundary)
+
+    def render(self):
+        tail = format_latex_response(self._tail)
+        if not self._frozen:
+            return tail
+        return f'{self._frozen}\n\n{tail}' if tail else self._frozen
+
+    def raw_text(self):
+        return ''.join(self._chunks)
+
+    def finish(self):
+        """Format the complete response exactly as non-streaming mode does"""
+        return format_latex_response(self.raw_text())
+
+
+class StreamingPreview:
+    """Feeds chunks through an IncrementalLatexFormatter, calling on_update
+    with the display text at most every min_interval seconds"""
+
+    def __init__(self, on_update, min_interval=0.05):
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.formatter = IncrementalLatexFormatter()
+        self._last_update = 0.0
+
+    def feed(self, chunk):
+        self.formatter.append(chunk)
+        now = time.monotonic()
+        # Throttled chunks are only buffered; the tail is formatted when an update is sent
+        if now - self._last_update >= self.min_interval:
+            self.on_update(self.formatter.render())
+            self._last_update = now
+
+    def reset(self):
+        """Start over, e.g. when a request is retried after partial output"""
+        self.formatter = IncrementalLatexFormatter()
+        self._last_update = 0.0
+        self.on_update('')
+
+    def finish(self):
+        self.on_update(self.formatter.render())
+        return self.formatter
@@ -0,0 +1,321 @@
+# llm_utils.py
+"""The tutor's model pipeline: system prompt, scheduling, and deadline-aware
+chat completions with retries and optional hedging. Used by app.py and by
+batch_solve.py, so both solve questions the same way.
+
+Every attempt streams from the API, even when the caller doesn't render
+partial output, because a stream is the only handle that lets us stop a
+request we no longer need. A turn gets OPENAI_TURN_BUDGET seconds in total:
+
+- each attempt is bounded by OPENAI_ATTEMPT_TIMEOUT (and what's left of the
+  budget), and transient failures are retried with full-jitter exponential
+  backoff while budget remains;
+- with OPENAI_HEDGE on, if no token has arrived by the configured percentile
+  of recent time-to-first-token, a second identical request is sent. The
+  first to produce a token wins, the other is closed, and its estimated
+  token usage is recorded.
+"""
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from context_utils import estimate_prompt_tokens
+from metrics_utils import record
+from resources import get_openai_client
+from scheduler import get_scheduler
+
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 1200
+TEMPERATURE = 0.7
+
+OPENAI_TURN_BUDGET = float(os.getenv("OPENAI_TURN_BUDGET", "60"))
+OPENAI_ATTEMPT_TIMEOUT = float(os.getenv("OPENAI_ATTEMPT_TIMEOUT", "45"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "false").lower() == "true"
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "95"))
+# Used until enough time-to-first-token samples have been seen
+OPENAI_HEDGE_DELAY = float(os.getenv("OPENAI_HEDGE_DELAY", "3"))
+HEDGE_MIN_SAMPLES = 20
+
+_first_token_samples = deque(maxlen=500)
+_samples_lock = threading.Lock()
+
+
+class AttemptTimeout(Exception):
+    """An attempt produced no complete response within its time limit"""
+
+
+def is_transient(error):
+    """Errors worth retrying: timeouts, dropped connections, 429s and 5xxs"""
+    import openai
+    return isinstance(error, (
+        AttemptTimeout,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError
+    ))
+
+
+def hedge_delay():
+    """Seconds to wait for a first token before sending a hedged request"""
+    with _samples_lock:
+        samples = sorted(_first_token_samples)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return OPENAI_HEDGE_DELAY
+    index = min(len(samples) - 1, int(len(samples) * OPENAI_HEDGE_PERCENTILE / 100))
+    return samples[index]
+
+
+class _Attempt:
+    """One streaming request running on a worker thread, reporting to a shared event queue"""
+
+    def __init__(self, number, events, messages, params, timeout):
+        self.number = number
+        self.events = events
+        self.messages = messages
+        self.params = params
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.completion_chunks = 0
+        self.cancelled = False
+        self._stream = None
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"openai-attempt-{self.number}", daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            client = get_openai_client().with_options(max_retries=0, timeout=self.timeout)
+            self._stream = client.chat.completions.create(
+                messages=self.messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **self.params
+            )
+            parts = []
+            usage = None
+            model = None
+            for chunk in self._stream:
+                if self.cancelled:
+                    break
+                model = chunk.model or model
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self.completion_chunks += 1
+                    parts.append(chunk.choices[0].delta.content)
+                    self.events.put(("chunk", self, chunk.choices[0].delta.content))
+            if self.cancelled:
+                return
+            self.events.put(("done", self, {
+                "content": "".join(parts),
+                "token_usage": {
+                    "prompt_tokens": usage.prompt_tokens if usage else None,
+                    "completion_tokens": usage.completion_tokens if usage else None,
+                    "total_tokens": usage.total_tokens if usage else None,
+                    "model": model
+                }
+            }))
+        except Exception as e:
+            if not self.cancelled:
+                self.events.put(("error", self, e))
+
+    def cancel(self):
+        """Stop the request; closing the stream drops the connection so generation stops"""
+        self.cancelled = True
+        try:
+            if self._stream is not None:
+                self._stream.close()
+        except Exception:
+            pass
+
+    def estimated_usage(self):
+        # A cancelled stream never sends its usage chunk; roughly one token per chunk
+        prompt_tokens = estimate_prompt_tokens(self.messages)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.completion_chunks,
+            "total_tokens": prompt_tokens + self.completion_chunks,
+            "model": self.params.get("model"),
+            "estimated": True
+        }
+
+
+def _cancel_losers(attempts, winner):
+    """Cancel every attempt except the winner and return their estimated usage"""
+    losers = []
+    for attempt in attempts:
+        if attempt is winner or attempt.cancelled:
+            continue
+        attempt.cancel()
+        usage = attempt.estimated_usage()
+        record("get_response.hedge_loser", (time.monotonic() - attempt.started_at) * 1000, token_usage=usage)
+        losers.append(usage)
+    return losers
+
+
+def _run_attempt(messages, params, time_limit, on_chunk):
+    """One (possibly hedged) attempt; returns the winning result or raises"""
+    events = queue.Queue()
+    start = time.monotonic()
+    attempt_deadline = start + time_limit
+    attempts = [_Attempt(0, events, messages, params, time_limit).start()]
+    hedge_at = start + hedge_delay() if OPENAI_HEDGE else None
+    winner = None
+    hedge_losers = []
+
+    while True:
+        now = time.monotonic()
+        wake_at = attempt_deadline if hedge_at is None else min(hedge_at, attempt_deadline)
+        try:
+            kind, attempt, payload = events.get(timeout=max(0.0, wake_at - now))
+        except queue.Empty:
+            now = time.monotonic()
+            if now >= attempt_deadline:
+                _cancel_losers(attempts, None)
+                raise AttemptTimeout(f"No complete response within {time_limit:.1f}s")
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if winner is None:
+                    remaining = attempt_deadline - now
+                    attempts.append(_Attempt(1, events, messages, params, remaining).start())
+            continue
+
+        if attempt.cancelled:
+            continue
+
+        if kind == "chunk":
+            if winner is None:
+                winner = attempt
+                with _samples_lock:
+                    _first_token_samples.append(time.monotonic() - attempt.started_at)
+                hedge_at = None
+                hedge_losers = _cancel_losers(attempts, winner)
+            if attempt is winner and on_chunk:
+                on_chunk(payload)
+        elif kind == "done":
+            if winner is None:
+                winner = attempt
+                hedge_losers = _cancel_losers(attempts, winner)
+            if attempt is winner:
+                if hedge_losers:
+                    payload["token_usage"]["hedge_losers"] = hedge_losers
+                return payload
+        elif kind == "error":
+            still_running = [other for other in attempts if other is not attempt and not other.cancelled]
+            attempt.cancelled = True
+            if attempt is winner or not still_running:
+                _cancel_losers(attempts, None)
+                raise payload
+
+
+def complete(messages, on_chunk=None, on_restart=None, **params):
+    """Chat completion within the turn budget; returns {"content", "token_usage"}.
+
+    on_chunk(text) is called on the caller's thread for each chunk of the
+    winning attempt. If a retry starts after chunks were already delivered,
+    on_restart() is called first so a live preview can be cleared.
+    """
+    deadline = time.monotonic() + OPENAI_TURN_BUDGET
+    delivered = {"any": False}
+
+    def deliver(text):
+        delivered["any"] = True
+        if on_chunk:
+            on_chunk(text)
+
+    last_error = None
+    for retry in range(OPENAI_MAX_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if delivered["any"] and on_restart:
+            on_restart()
+            delivered["any"] = False
+        try:
+            return _run_attempt(messages, params, min(remaining, OPENAI_ATTEMPT_TIMEOUT), deliver)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            last_error = e
+            record("get_response.retry", 0.0, error=True)
+
+        # Full jitter: sleep anywhere up to the exponential cap, if the budget allows
+        delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** retry))
+        if time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+
+    raise last_error or AttemptTimeout(f"No response within the {OPENAI_TURN_BUDGET:.0f}s turn budget")
+
+
+def update_system_message(subject, question_type):
+    """System prompt for a subject and question type; shared by the app and batch_solve"""
+    return {
+        "role": "system",
+        "content": f"""You are a helpful tutor specializing in IIT JEE preparation. 
+        Current Subject: {subject if subject else 'Not Specified'}
+        Question Type: {question_type if question_type else 'Not Specified'}
+        
+        Follow these strict rules for mathematical expressions:
+        1. For display/block equations (equations on their own line), ONLY use $$...$$
+        2. For inline equations (equations within text), ONLY use $...$
+        3. Never use [] or () as math delimiters
+        4. Always use \\text{{}} for units
+        5. Add proper spacing with \\, between numbers and units
+        
+        Structure your responses as:
+        - **Question Analysis:** (Brief overview)
+        - **Solution Steps:** (Step-by-step solution, try to stick to the point)
+        - **Final Answer:** (Clear conclusion, matching the question type format)"""
+    }
+
+
+def _total_tokens(response):
+    return response["token_usage"].get("total_tokens")
+
+
+def _coalesced(response):
+    """A response shared with an identical in-flight request, which used no tokens of its own"""
+    return {
+        **response,
+        "token_usage": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "model": response["token_usage"].get("model"),
+            "coalesced": True
+        }
+    }
+
+
+def scheduled_completion(messages, stream=False, user_id=None, on_chunk=None, on_restart=None):
+    """complete() through the process-wide scheduler.
+
+    Identical in-flight requests (same thread, same mode) share one upstream
+    call; only the caller that made it sees on_chunk/on_restart.
+    """
+    payload = {"model": MODEL, "max_tokens": MAX_TOKENS, "stream": stream, "messages": messages}
+    return get_scheduler().call(
+        user_id,
+        payload,
+        lambda: complete(
+            messages,
+            on_chunk=on_chunk,
+            on_restart=on_restart,
+            model=MODEL,
+            max_tokens=MAX_TOKENS,
+            temperature=TEMPERATURE
+        ),
+        estimated_tokens=estimate_prompt_tokens(messages) + MAX_TOKENS,
+        usage=_total_tokens,
+        share=_coalesced
+    )
@@ -0,0 +1,181 @@
+# metrics_utils.py
+"""Latency, token and cost telemetry for model, upload and database calls.
+
+Calls are timed in-process into fixed log-spaced latency histograms keyed by
+(operation, subject, question type). A background thread flushes one compact
+document per key per window into the metrics collection, so percentiles can
+be aggregated across processes and time ranges by summing bucket counts.
+"""
+import atexit
+import bisect
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+from datetime import datetime
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS", "60"))
+
+# Upper bounds (ms) of the latency buckets, 1.5x apart from 1 ms to about 2 minutes
+LATENCY_BUCKETS_MS = tuple(round(1.5 ** i, 1) for i in range(30))
+
+# USD per million (prompt, completion) tokens
+MODEL_PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00)
+}
+
+_labels = contextvars.ContextVar("metrics_labels", default=None)
+_series = {}
+_series_lock = threading.Lock()
+_window_start = datetime.now()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def metric_labels(subject=None, question_type=None):
+    """Attribute every call timed inside this block to a subject and question type"""
+    token = _labels.set({"subject": subject or "None", "question_type": question_type or "None"})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def estimate_cost(token_usage):
+    """Estimated USD cost of one model call from its token_usage dict"""
+    if not token_usage:
+        return 0.0
+    model = token_usage.get("model") or ""
+    # Dated snapshots like gpt-4o-mini-2024-07-18 share their family's price
+    family = max((name for name in MODEL_PRICES_PER_MILLION if model.startswith(name)), key=len, default=None)
+    if family is None:
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES_PER_MILLION[family]
+    return (
+        (token_usage.get("prompt_tokens") or 0) * prompt_price
+        + (token_usage.get("completion_tokens") or 0) * completion_price
+    ) / 1_000_000
+
+
+def _new_series():
+    return {
+        "count": 0,
+        "errors": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cost_usd": 0.0
+    }
+
+
+def record(operation, duration_ms, error=False, token_usage=None):
+    """Add one timed call to the current window"""
+    if not METRICS_ENABLED:
+        return
+    labels = _labels.get() or {"subject": "None", "question_type": "None"}
+    key = (operation, labels["subject"], labels["question_type"])
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, duration_ms)
+    with _series_lock:
+        series = _series.get(key)
+        if series is None:
+            series = _series[key] = _new_series()
+        series["count"] += 1
+        series["errors"] += 1 if error else 0
+        series["total_ms"] += duration_ms
+        series["max_ms"] = max(series["max_ms"], duration_ms)
+        series["buckets"][bucket] += 1
+        if token_usage:
+            series["prompt_tokens"] += token_usage.get("prompt_tokens") or 0
+            series["completion_tokens"] += token_usage.get("completion_tokens") or 0
+            series["cost_usd"] += estimate_cost(token_usage)
+    _ensure_flusher()
+
+
+def timed(operation, usage=None, none_is_error=False):
+    """Decorator that records latency (and token usage via usage(result)) for every call.
+
+    A call that raises counts as an error; so does returning None when
+    none_is_error is set, which is how the app's helpers report failures.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = none_is_error and result is None
+                return result
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+                token_usage = usage(result) if usage and result is not None else None
+                record(operation, duration_ms, error=failed, token_usage=token_usage)
+        return wrapper
+    return decorator
+
+
+def percentile_from_buckets(buckets, q):
+    """Approximate percentile (0-100) from histogram counts, as the bucket's upper bound"""
+    total = sum(buckets)
+    if not total:
+        return None
+    threshold = total * q / 100
+    running = 0
+    for i, count in enumerate(buckets):
+        running += count
+        if running >= threshold:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float("inf")
+    return float("inf")
+
+
+def flush():
+    """Write the current window to the metrics collection and start a new one"""
+    global _series, _window_start
+    with _series_lock:
+        series, _series = _series, {}
+        window_start, _window_start = _window_start, datetime.now()
+    if not series:
+        return
+
+    documents = [
+        {
+            "operation": operation,
+            "subject": subject,
+            "question_type": question_type,
+            "window_start": window_start,
+            "window_end": datetime.now(),
+            "pid": os.getpid(),
+            **values
+        }
+        for (operation, subject, question_type), values in series.items()
+    ]
+    try:
+        # Imported here: db_utils itself is instrumented with this module
+        from db_utils import add_metrics
+        add_metrics(documents)
+    except Exception as e:
+        print(f"Could not flush {len(documents)} metrics documents: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _flusher_lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+                _flusher.start()
+                atexit.register(flush)
@@ -0,0 +1,128 @@
+# pages/admin_metrics.py
+import os
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from auth_utils import restore_session
+from cache_utils import cache_stats
+from db_utils import get_metrics, write_queue_depth
+from metrics_utils import LATENCY_BUCKETS_MS, flush, percentile_from_buckets
+from scheduler import get_scheduler
+
+# Comma-separated phone numbers allowed to see this page
+ADMIN_USERS = {user.strip() for user in os.getenv("ADMIN_USERS", "").split(",") if user.strip()}
+
+WINDOWS = {
+    "Last hour": timedelta(hours=1),
+    "Last 24 hours": timedelta(days=1),
+    "Last 7 days": timedelta(days=7)
+}
+GROUPINGS = {
+    "Operation": ("operation",),
+    "Operation + subject": ("operation", "subject"),
+    "Operation + subject + question type": ("operation", "subject", "question_type")
+}
+
+st.set_page_config(page_title="Metrics", layout="wide")
+
+if not restore_session() or st.session_state.get("username") not in ADMIN_USERS:
+    st.warning("This page is only available to admins.")
+    st.stop()
+
+st.title("📈 Latency and Cost")
+
+col1, col2, col3 = st.columns([2, 3, 1])
+with col1:
+    window = st.selectbox("Window", list(WINDOWS))
+with col2:
+    grouping = st.selectbox("Group by", list(GROUPINGS))
+with col3:
+    if st.button("Flush this process"):
+        flush()
+
+# Live scheduler state for this server process; queue waits are also in the table below
+scheduler_stats = get_scheduler().stats()
+cols = st.columns(5)
+cols[0].metric("OpenAI in flight", scheduler_stats["in_flight"])
+cols[1].metric("Queued", scheduler_stats["queued"])
+cols[2].metric("Mean queue wait", f"{scheduler_stats['mean_wait_ms']:.0f} ms")
+cols[3].metric("Rejected", scheduler_stats["rejected"])
+cols[4].metric("Coalesced", scheduler_stats["coalesced"])
+
+# Answer cache and write-behind queue, also for this process only
+process_cache = cache_stats()
+cols = st.columns(5)
+cols[0].metric("Cache hit rate (process)", f"{process_cache['hit_rate']:.0%}")
+cols[1].metric("Local cache entries", process_cache["local_entries"])
+cols[2].metric("Shared-tier hits", process_cache["shared_hits"])
+cols[3].metric("Cache errors", process_cache["errors"])
+cols[4].metric("Write queue depth", write_queue_depth())
+
+# Sum histogram buckets and counters across windows and processes
+group_fields = GROUPINGS[grouping]
+groups = {}
+operations = {}
+for document in get_metrics(datetime.now() - WINDOWS[window]):
+    totals = operations.setdefault(document["operation"], {"count": 0, "total_ms": 0.0})
+    totals["count"] += document.get("count", 0)
+    totals["total_ms"] += document.get("total_ms", 0.0)
+    key = tuple(document.get(field, "None") for field in group_fields)
+    group = groups.setdefault(key, {
+        "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+        "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+    })
+    for field in ("count", "errors", "total_ms", "prompt_tokens", "completion_tokens", "cost_usd"):
+        group[field] += document.get(field, 0)
+    group["max_ms"] = max(group["max_ms"], document.get("max_ms", 0.0))
+    group["buckets"] = [a + b for a, b in zip(group["buckets"], document["buckets"])]
+
+if not groups:
+    st.info("No metrics recorded in this window yet.")
+    st.stop()
+
+rows = []
+for key, group in sorted(groups.items(), key=lambda item: -item[1]["total_ms"]):
+    rows.append({
+        **dict(zip(group_fields, key)),
+        "calls": group["count"],
+        "errors": group["errors"],
+        "total_s": round(group["total_ms"] / 1000, 1),
+        "mean_ms": round(group["total_ms"] / group["count"], 1),
+        "p50_ms": percentile_from_buckets(group["buckets"], 50),
+        "p95_ms": percentile_from_buckets(group["buckets"], 95),
+        "p99_ms": percentile_from_buckets(group["buckets"], 99),
+        "max_ms": round(group["max_ms"], 1),
+        "prompt_tokens": group["prompt_tokens"],
+        "completion_tokens": group["completion_tokens"],
+        "cost_usd": round(group["cost_usd"], 4)
+    })
+
+# Symbolic fast path: hit rate, and model time saved at the mean model latency for this window
+hits = operations.get("symbolic.hit", {"count": 0, "total_ms": 0.0})
+misses = operations.get("symbolic.miss", {"count": 0, "total_ms": 0.0})
+model_calls = [operations[name] for name in ("get_response", "get_response_stream") if name in operations]
+model_count = sum(totals["count"] for totals in model_calls)
+if hits["count"] + misses["count"]:
+    model_mean_ms = sum(totals["total_ms"] for totals in model_calls) / model_count if model_count else 0.0
+    saved_s = hits["count"] * model_mean_ms / 1000 - hits["total_ms"] / 1000
+    cols = st.columns(3)
+    cols[0].metric("Symbolic hit rate", f"{hits['count'] / (hits['count'] + misses['count']):.0%}")
+    cols[1].metric("Symbolic answers", hits["count"])
+    cols[2].metric("Model time saved", f"{saved_s:,.1f} s" if model_count else "n/a")
+
+# Answer cache across every process in the window
+cache_counts = {stat: operations.get(f"answer_cache.{stat}", {"count": 0})["count"] for stat in ("local_hits", "shared_hits", "misses")}
+cache_lookups = sum(cache_counts.values())
+if cache_lookups:
+    cols = st.columns(3)
+    cols[0].metric("Answer cache hit rate", f"{(cache_counts['local_hits'] + cache_counts['shared_hits']) / cache_lookups:.0%}")
+    cols[1].metric("Cache hits (local / shared)", f"{cache_counts['local_hits']} / {cache_counts['shared_hits']}")
+    cols[2].metric("Cache misses", cache_counts["misses"])
+
+total_cost = sum(row["cost_usd"] for row in rows)
+total_seconds = sum(row["total_s"] for row in rows)
+st.metric("Estimated cost", f"${total_cost:,.4f}")
+st.caption(f"{total_seconds:,.1f} s of timed work, sorted by total time. Percentiles are histogram upper bounds.")
+st.dataframe(rows, use_container_width=True)
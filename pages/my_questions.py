@@ -0,0 +1,71 @@
+# pages/my_questions.py
+import streamlit as st
+
+from auth_utils import restore_session
+from db_utils import get_question_thread, list_user_questions
+
+st.set_page_config(page_title="My Questions", layout="wide")
+
+if not restore_session():
+    st.warning("Please log in to see your questions.")
+    st.stop()
+
+user_id = st.session_state["user_id"]
+
+# Loaded pages accumulate here; "Load more" fetches only the next page by cursor
+if st.session_state.get("history_user") != user_id:
+    st.session_state["history_user"] = user_id
+    st.session_state["history_items"], st.session_state["history_cursor"] = list_user_questions(user_id)
+    st.session_state["history_threads"] = {}
+
+
+def load_more():
+    items, st.session_state["history_cursor"] = list_user_questions(user_id, st.session_state["history_cursor"])
+    st.session_state["history_items"].extend(items)
+
+
+def open_thread(question_id):
+    # Threads are only fetched when opened, then kept for the rest of the session
+    if question_id not in st.session_state["history_threads"]:
+        st.session_state["history_threads"][question_id] = get_question_thread(question_id, user_id)
+
+
+def refresh():
+    del st.session_state["history_user"]
+
+
+st.title("🗂️ My Questions")
+st.button("Refresh", on_click=refresh)
+
+items = st.session_state["history_items"]
+if not items:
+    st.info("You haven't asked any questions yet.")
+
+for item in items:
+    title = item["first_line"] or ("Image question" if item["has_image"] else "(no text)")
+    cols = st.columns([6, 2, 2, 1, 1])
+    cols[0].markdown(f"{'🖼️ ' if item['has_image'] else ''}**{title}**")
+    cols[1].caption(f"{item['subject']} · {item['question_type']}")
+    cols[2].caption(item["timestamp"].strftime("%d %b %Y, %H:%M"))
+    cols[3].caption(f"{item['turns']} turn(s)")
+    cols[4].button("Open", key=f"open_{item['question_id']}", on_click=open_thread, args=(item["question_id"],))
+
+    thread = st.session_state["history_threads"].get(item["question_id"])
+    if thread:
+        with st.container(border=True):
+            if thread["image_url"]:
+                st.image(thread["image_url"], width=200)
+            previous = None
+            for message in thread["messages"]:
+                # The opening question is stored both by add_question and as the first turn
+                if message["role"] == "user" and previous and previous["role"] == "user" and previous["content"] == message["content"]:
+                    continue
+                previous = message
+                if message["role"] == "user":
+                    content = message["content"] if isinstance(message["content"], str) else "Image uploaded"
+                    st.info(f"📝 Your Question: {content}")
+                elif message["role"] == "assistant":
+                    st.markdown(f"🤖 **Solution:**\n{message['content']}", unsafe_allow_html=True)
+
+if st.session_state["history_cursor"]:
+    st.button("Load more", on_click=load_more)
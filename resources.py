@@ -0,0 +1,77 @@
+# resources.py
+"""Process-wide registry of pooled service clients.
+
+Streamlit re-executes app.py on every interaction, but imported modules
+live for the whole server process. Clients created here are built lazily on
+first use and then shared by every rerun and every session, so their
+connection pools survive. Heavy SDK imports happen inside the factories.
+"""
+import os
+import threading
+
+from dotenv import load_dotenv
+
+# Runs once per process, not on every rerun
+load_dotenv()
+
+_factories = {}
+_resources = {}
+_lock = threading.Lock()
+
+
+def register_factory(name, factory):
+    """Register how to build a resource; it is only called on first use"""
+    _factories[name] = factory
+
+
+def get_resource(name):
+    resource = _resources.get(name)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(name)
+            if resource is None:
+                resource = _factories[name]()
+                _resources[name] = resource
+    return resource
+
+
+def override_resource(name, resource):
+    """Swap in a stand-in (e.g. a fake client in benchmarks) before first use"""
+    with _lock:
+        _resources[name] = resource
+
+
+def _create_openai_client():
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+def _create_imagekit():
+    from imagekitio import ImageKit
+    return ImageKit(
+        private_key=os.getenv("IMAGEKIT_PRIVATE_KEY"),
+        public_key=os.getenv("IMAGEKIT_PUBLIC_KEY"),
+        url_endpoint=os.getenv("IMAGEKIT_URL_ENDPOINT")
+    )
+
+
+def _create_mongo_client():
+    import pymongo
+    return pymongo.MongoClient(os.getenv("MONGODB_URI"))
+
+
+register_factory("openai", _create_openai_client)
+register_factory("imagekit", _create_imagekit)
+register_factory("mongo", _create_mongo_client)
+
+
+def get_openai_client():
+    return get_resource("openai")
+
+
+def get_imagekit():
+    return get_resource("imagekit")
+
+
+def get_mongo_client():
+    return get_resource("mongo")
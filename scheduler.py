@@ -0,0 +1,201 @@
+# scheduler.py
+"""Process-wide admission control for OpenAI calls.
+
+Every model call goes through one OpenAIScheduler per server process, which
+
+- caps the number of requests in flight,
+- spends from a tokens-per-minute bucket so bursts don't turn into 429s,
+- serves waiting users round-robin so one busy session can't starve others,
+- coalesces identical in-flight requests ("single flight") so a class
+  asking the same question at once makes one upstream call.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from metrics_utils import record
+
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "8"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "200"))
+OPENAI_MAX_QUEUE_WAIT = float(os.getenv("OPENAI_MAX_QUEUE_WAIT", "30"))
+
+
+class SchedulerRejected(Exception):
+    """Raised when a request can't be admitted within the queue limits"""
+
+
+def request_key(payload):
+    """Stable hash of a request payload, used to find identical in-flight calls"""
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class OpenAIScheduler:
+    def __init__(self, max_in_flight, tokens_per_minute, max_queue, max_wait):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user -> deque of waiting tickets, in round-robin order
+        self._queued = 0
+        self._in_flight = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._flights = {}
+        self._stats = {"dispatched": 0, "coalesced": 0, "rejected": 0, "total_wait_ms": 0.0}
+
+    def call(self, user_id, payload, func, estimated_tokens, usage=None, share=None):
+        """Run func() under the scheduler and return its result.
+
+        Identical payloads already in flight share that call's result instead,
+        passed through share(result) if given, so the upstream cost is only
+        counted for the caller that paid it. usage(result) may return the
+        actual total tokens so the bucket can be corrected after the call.
+        """
+        key = request_key(payload)
+        with self._cond:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            # No timeout of our own: the leader always settles the future, after at most
+            # its queue wait plus the model call's turn budget, and any rejection is shared
+            result = flight.result()
+            return share(result) if share and result is not None else result
+
+        try:
+            self._acquire(user_id, estimated_tokens)
+            actual_tokens = None
+            try:
+                result = func()
+                actual_tokens = usage(result) if usage and result is not None else None
+            finally:
+                self._release(estimated_tokens, actual_tokens)
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                self._flights.pop(key, None)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.tokens_per_minute),
+            self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60
+        )
+        self._refilled_at = now
+
+    def _reject(self, waited_ms):
+        with self._cond:
+            self._stats["rejected"] += 1
+        record("scheduler.queue_wait", waited_ms, error=True)
+        raise SchedulerRejected("The tutor is busy right now. Please try again in a moment.")
+
+    def _acquire(self, user_id, estimated_tokens):
+        # A single request larger than the whole budget waits for a full bucket instead of forever
+        needed = min(estimated_tokens, self.tokens_per_minute)
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        admitted = False
+        with self._cond:
+            if self._queued < self.max_queue:
+                self._queues.setdefault(user_id, deque()).append(ticket)
+                self._queued += 1
+                admitted = self._wait_for_turn(user_id, ticket, needed, deadline)
+            if admitted:
+                self._in_flight += 1
+                self._tokens -= needed
+                self._stats["dispatched"] += 1
+                self._stats["total_wait_ms"] += (time.monotonic() - start) * 1000
+                self._cond.notify_all()
+
+        waited_ms = (time.monotonic() - start) * 1000
+        if not admitted:
+            self._reject(waited_ms)
+        record("scheduler.queue_wait", waited_ms)
+
+    def _wait_for_turn(self, user_id, ticket, needed, deadline):
+        """Block (holding the condition) until ticket may dispatch; False on timeout"""
+        while True:
+            self._refill()
+            head_user = next(iter(self._queues))
+            is_next = self._queues[head_user][0] is ticket
+            if is_next and self._in_flight < self.max_in_flight and self._tokens >= needed:
+                # Dispatch, then move this user behind everyone else who is waiting
+                self._remove(user_id, ticket)
+                if user_id in self._queues:
+                    self._queues.move_to_end(user_id)
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._remove(user_id, ticket)
+                self._cond.notify_all()
+                return False
+
+            timeout = remaining
+            if is_next and self._tokens < needed:
+                timeout = min(timeout, (needed - self._tokens) * 60 / self.tokens_per_minute)
+            self._cond.wait(timeout)
+
+    def _remove(self, user_id, ticket):
+        queue = self._queues[user_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[user_id]
+        self._queued -= 1
+
+    def _release(self, estimated_tokens, actual_tokens):
+        with self._cond:
+            self._in_flight -= 1
+            if actual_tokens is not None:
+                # Refund an over-estimate, or charge for an under-estimate
+                self._tokens = min(
+                    float(self.tokens_per_minute),
+                    self._tokens + min(estimated_tokens, self.tokens_per_minute) - actual_tokens
+                )
+            self._cond.notify_all()
+
+    def stats(self):
+        """Counters for sizing workers: in flight, queued, rejections and mean queue wait"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["in_flight"] = self._in_flight
+            stats["queued"] = self._queued
+            stats["tokens_available"] = int(self._tokens)
+        dispatched = stats["dispatched"]
+        stats["mean_wait_ms"] = stats.pop("total_wait_ms") / dispatched if dispatched else 0.0
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = OpenAIScheduler(
+                    OPENAI_MAX_IN_FLIGHT,
+                    OPENAI_TOKENS_PER_MINUTE,
+                    OPENAI_MAX_QUEUE,
+                    OPENAI_MAX_QUEUE_WAIT
+                )
+    return _scheduler
@@ -0,0 +1,383 @@
+# similarity_utils.py
+"""In-process index of similar past questions.
+
+Question text is turned into a fixed-size hashed n-gram vector (word
+unigrams and bigrams plus character trigrams, sublinear counts, L2
+normalized), so vectors can be added one at a time without a vocabulary or
+refitting. Vectors are kept in one NumPy matrix per subject and a query is a
+single matrix-vector product.
+
+The index is saved under SIMILARITY_INDEX_DIR as one .npy file per subject,
+which is memory-mapped on startup; only questions newer than the snapshot
+are read back from Mongo. That happens on a background thread started by
+warm_index(); until it finishes, similar_questions returns nothing rather
+than stall a student's page. Each server process keeps its own copy,
+updated by add_question for the questions it inserts. Processes share the
+snapshot directory: each save writes its own uniquely named files and then
+swaps in the manifest, and built_until only covers rows read from Mongo,
+so another process's questions are never skipped.
+"""
+import atexit
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from cache_utils import normalize_question_text
+from metrics_utils import timed
+
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "true").lower() == "true"
+SIMILARITY_INDEX_DIR = os.getenv("SIMILARITY_INDEX_DIR", ".similarity_index")
+SIMILARITY_DIMENSIONS = int(os.getenv("SIMILARITY_DIMENSIONS", "512"))
+SIMILARITY_MIN_SCORE = float(os.getenv("SIMILARITY_MIN_SCORE", "0.45"))
+# Questions added before the snapshot is rewritten in the background
+SIMILARITY_SNAPSHOT_EVERY = int(os.getenv("SIMILARITY_SNAPSHOT_EVERY", "1000"))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[^\sa-z0-9]")
+_CHAR_NGRAM = 3
+_CHAR_NGRAM_WEIGHT = 0.5
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+# Catch-up re-reads this far before built_until, for questions other processes
+# stamped earlier but wrote later (e.g. from their write-behind queue)
+_CATCH_UP_OVERLAP = timedelta(minutes=5)
+# Snapshot files no manifest names are removed once they are this old (seconds);
+# younger ones may belong to a save still in progress in another process
+_ORPHAN_AGE = 3600
+
+
+def _features(text):
+    """Weighted hashed features of a question as {column: weight}"""
+    tokens = _TOKEN_RE.findall(normalize_question_text(text).lower())
+    counts = {}
+    grams = [(token, 1.0) for token in tokens]
+    grams += [(f"{a} {b}", 1.0) for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        if len(token) > _CHAR_NGRAM:
+            padded = f"<{token}>"
+            grams += [
+                (f"#{padded[i:i + _CHAR_NGRAM]}", _CHAR_NGRAM_WEIGHT)
+                for i in range(len(padded) - _CHAR_NGRAM + 1)
+            ]
+    for gram, weight in grams:
+        digest = zlib.crc32(gram.encode("utf-8"))
+        column = digest % SIMILARITY_DIMENSIONS
+        # A second hash bit picks the sign so collisions cancel out on average
+        sign = 1.0 if (digest // SIMILARITY_DIMENSIONS) & 1 else -1.0
+        counts[column] = counts.get(column, 0.0) + sign * weight
+    return counts
+
+
+def vectorize(text):
+    """Unit-length float32 vector for text, or None if it has no features"""
+    import numpy as np
+
+    counts = _features(text)
+    if not counts:
+        return None
+    vector = np.zeros(SIMILARITY_DIMENSIONS, dtype=np.float32)
+    columns = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    # Sublinear term frequency keeps repeated words from dominating
+    vector[columns] = np.sign(values) * np.log1p(np.abs(values))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+class _Partition:
+    """Vectors for one subject: a read-only snapshot plus rows added since"""
+
+    def __init__(self, base=None, ids=None):
+        import numpy as np
+
+        self.base = base if base is not None else np.zeros((0, SIMILARITY_DIMENSIONS), dtype=np.float32)
+        self.ids = list(ids or [])
+        self.extra = np.zeros((16, SIMILARITY_DIMENSIONS), dtype=np.float32)
+        self.extra_count = 0
+
+    def add(self, question_id, vector):
+        import numpy as np
+
+        if self.extra_count == len(self.extra):
+            # Grow by doubling so inserts stay amortized O(1)
+            self.extra = np.concatenate([self.extra, np.zeros_like(self.extra)])
+        self.extra[self.extra_count] = vector
+        self.extra_count += 1
+        self.ids.append(question_id)
+
+    def search(self, vector, k):
+        """[(score, question_id)] for the k best rows"""
+        import numpy as np
+
+        scores = np.concatenate([self.base @ vector, self.extra[:self.extra_count] @ vector])
+        if not len(scores):
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[i]), self.ids[i]) for i in top]
+
+    def row(self, number):
+        if number < len(self.base):
+            return self.base[number]
+        return self.extra[number - len(self.base)]
+
+    def matrix(self):
+        import numpy as np
+
+        return np.concatenate([np.asarray(self.base), self.extra[:self.extra_count]])
+
+
+class SimilarityIndex:
+    def __init__(self, directory, dimensions):
+        self.directory = directory
+        self.dimensions = dimensions
+        self.partitions = {}
+        self.built_until = None
+        self._known = set()
+        self._unsaved = 0
+        # Files of this process's previous save, superseded by its next one
+        self._files = set()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def add(self, question_id, text, subject):
+        """Index one question; ids already indexed are ignored"""
+        question_id = str(question_id)
+        vector = vectorize(text) if text else None
+        with self._lock:
+            if vector is None or question_id in self._known:
+                return
+            self._known.add(question_id)
+            partition = self.partitions.get(subject or "None")
+            if partition is None:
+                partition = self.partitions[subject or "None"] = _Partition()
+            partition.add(question_id, vector)
+            self._unsaved += 1
+            save_now = self._unsaved >= SIMILARITY_SNAPSHOT_EVERY
+        if save_now:
+            self._save_in_background()
+
+    def search(self, text, subject=None, k=5, min_score=SIMILARITY_MIN_SCORE):
+        """[(score, question_id)] best first; subject None or "None" searches every subject"""
+        vector = vectorize(text) if text else None
+        if vector is None:
+            return []
+        with self._lock:
+            if subject and subject != "None":
+                partitions = [self.partitions[subject]] if subject in self.partitions else []
+            else:
+                partitions = list(self.partitions.values())
+            results = [hit for partition in partitions for hit in partition.search(vector, k)]
+        results = [hit for hit in results if hit[0] >= min_score]
+        return sorted(results, reverse=True)[:k]
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _write_unique(self, prefix, suffix, write):
+        """Write a new file under a name no other process is using; returns the name"""
+        descriptor, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as output:
+                write(output)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return os.path.basename(path)
+
+    def save(self):
+        """Write the snapshot atomically and re-map it, so saved rows leave the heap"""
+        import numpy as np
+
+        with self._save_lock:
+            with self._lock:
+                snapshot = {subject: (partition.matrix(), list(partition.ids)) for subject, partition in self.partitions.items()}
+                built_until = self.built_until
+                saved = self._unsaved
+
+            os.makedirs(self.directory, exist_ok=True)
+            manifest = {
+                "dimensions": self.dimensions,
+                "built_until": built_until.isoformat() if built_until else None,
+                "partitions": {}
+            }
+            for subject, (matrix, ids) in snapshot.items():
+                file_name = self._write_unique(
+                    f"vectors-{_SLUG_RE.sub('-', subject.lower())}-", ".npy",
+                    lambda output: np.save(output, matrix)
+                )
+                manifest["partitions"][subject] = {"file": file_name, "ids": ids}
+            # Other processes keep reading whichever complete manifest was there before this
+            manifest_name = self._write_unique(
+                "index-", ".json.tmp", lambda output: output.write(json.dumps(manifest).encode("utf-8"))
+            )
+            os.replace(self._path(manifest_name), self._path("index.json"))
+
+            with self._lock:
+                for subject, entry in manifest["partitions"].items():
+                    current = self.partitions[subject]
+                    fresh = _Partition(np.load(self._path(entry["file"]), mmap_mode="r"), entry["ids"])
+                    # Keep rows added while the files were being written
+                    for row in range(len(entry["ids"]), len(current.ids)):
+                        fresh.add(current.ids[row], current.row(row))
+                    self.partitions[subject] = fresh
+                self._unsaved -= saved
+            previous, self._files = self._files, {entry["file"] for entry in manifest["partitions"].values()}
+            self._remove_stale(previous)
+
+    def _remove_stale(self, previous):
+        """Delete superseded snapshot files; mapped pages stay readable after an unlink.
+
+        This process's previous files go straight away; files no manifest
+        names, left by other processes, once they are _ORPHAN_AGE old.
+        """
+        cutoff = time.time() - _ORPHAN_AGE
+        for file_name in os.listdir(self.directory):
+            if file_name in self._files or not file_name.startswith(("vectors-", "index-")):
+                continue
+            try:
+                if file_name in previous or os.path.getmtime(self._path(file_name)) < cutoff:
+                    os.unlink(self._path(file_name))
+            except OSError:
+                pass
+
+    def _save_in_background(self):
+        if not self._save_lock.locked():
+            threading.Thread(target=self.save, name="similarity-snapshot", daemon=True).start()
+
+    def load(self):
+        """Memory-map a saved snapshot; returns False if there is none usable"""
+        import numpy as np
+
+        try:
+            with open(self._path("index.json")) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["dimensions"] != self.dimensions:
+                return False
+            partitions = {
+                subject: _Partition(np.load(self._path(entry["file"]), mmap_mode="r"), entry["ids"])
+                for subject, entry in manifest["partitions"].items()
+            }
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Ignoring unreadable similarity index snapshot: {e}")
+            return False
+        with self._lock:
+            self.partitions = partitions
+            self._known = {question_id for partition in partitions.values() for question_id in partition.ids}
+            self.built_until = datetime.fromisoformat(manifest["built_until"]) if manifest["built_until"] else None
+        return True
+
+
+_index = None
+_index_lock = threading.Lock()
+# Questions inserted while the index is loading, applied once it's ready
+_pending = []
+_pending_lock = threading.Lock()
+_loading = False
+_warm_thread = None
+
+
+def get_index():
+    """The process-wide index: snapshot first, then whatever Mongo has that's newer"""
+    global _index, _loading
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                # Imported here: db_utils imports this module from add_question
+                from db_utils import flush_writes, iter_questions_since
+
+                with _pending_lock:
+                    _loading = True
+                index = SimilarityIndex(SIMILARITY_INDEX_DIR, SIMILARITY_DIMENSIONS)
+                loaded = index.load()
+                flush_writes()
+                added = 0
+                since = index.built_until - _CATCH_UP_OVERLAP if index.built_until else None
+                newest = index.built_until
+                for document in iter_questions_since(since):
+                    index.add(document["_id"], document.get("question_text"), document.get("subject"))
+                    timestamp = document.get("timestamp")
+                    if timestamp and (newest is None or timestamp > newest):
+                        newest = timestamp
+                    added += 1
+                # Only rows read from Mongo count; questions added later, here or in
+                # another process, are caught up from this point on the next load
+                index.built_until = newest
+                if added or not loaded:
+                    index.save()
+                with _pending_lock:
+                    for args in _pending:
+                        index.add(*args)
+                    _pending.clear()
+                    _index = index
+                    _loading = False
+                atexit.register(index.save)
+    return _index
+
+
+def index_ready():
+    return _index is not None
+
+
+def warm_index():
+    """Start loading the index in the background, once per process"""
+    global _warm_thread
+    if not SIMILARITY_ENABLED or _index is not None:
+        return
+    with _pending_lock:
+        if _warm_thread is not None:
+            return
+        _warm_thread = threading.Thread(target=_warm, name="similarity-index", daemon=True)
+    _warm_thread.start()
+
+
+def _warm():
+    global _warm_thread
+    try:
+        get_index()
+    except Exception as e:
+        print(f"Could not build the similarity index: {e}")
+        # Let a later warm_index() try again
+        with _pending_lock:
+            _warm_thread = None
+
+
+def index_question(question_id, question_text, subject):
+    """Called by add_question. Until the index is first used there's nothing to
+    update: loading catches up from Mongo anyway."""
+    if not SIMILARITY_ENABLED:
+        return
+    with _pending_lock:
+        if _index is None:
+            if _loading:
+                _pending.append((question_id, question_text, subject))
+            return
+    _index.add(question_id, question_text, subject)
+
+
+@timed("similar_questions")
+def similar_questions(question_text, subject=None, k=3):
+    """Up to k similar questions that already have a solution, best first.
+
+    Empty while the index is still loading in the background.
+    """
+    if not SIMILARITY_ENABLED or not normalize_question_text(question_text):
+        return []
+    if _index is None:
+        warm_index()
+        return []
+    from db_utils import get_solved_questions
+
+    # Over-fetch: unanswered or abandoned questions are dropped below
+    hits = _index.search(question_text, subject, k=k * 3)
+    documents = get_solved_questions([question_id for _, question_id in hits])
+    results = [
+        {**documents[question_id], "score": score}
+        for score, question_id in hits
+        if question_id in documents
+    ]
+    return results[:k]
@@ -0,0 +1,423 @@
+# symbolic_utils.py
+"""Deterministic answers for plain arithmetic and algebra questions.
+
+Text-only questions that are just an expression to evaluate, an equation to
+solve, or a derivative/integral to take are answered locally with SymPy in
+the same Question Analysis / Solution Steps / Final Answer structure the
+model is asked for. Anything the parser isn't sure about returns None and
+goes to the model as before.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from metrics_utils import record
+
+SYMBOLIC_FAST_PATH = os.getenv("SYMBOLIC_FAST_PATH", "true").lower() == "true"
+SYMBOLIC_MAX_LENGTH = int(os.getenv("SYMBOLIC_MAX_LENGTH", "200"))
+SYMBOLIC_TIMEOUT = float(os.getenv("SYMBOLIC_TIMEOUT", "2"))
+# Solves allowed to run at once, counting timed-out ones that haven't finished yet
+SYMBOLIC_WORKERS = int(os.getenv("SYMBOLIC_WORKERS", "2"))
+# Larger powers and numbers are left to the model rather than risk a runaway computation
+SYMBOLIC_MAX_EXPONENT = 20
+SYMBOLIC_MAX_DIGITS = 30
+
+_FUNCTIONS = {
+    "sin", "cos", "tan", "cot", "sec", "csc", "asin", "acos", "atan",
+    "sinh", "cosh", "tanh", "log", "ln", "exp", "sqrt", "abs", "pi"
+}
+# The only tokens an expression may contain; anything else means it isn't pure math
+_TOKEN_RE = re.compile(r"\s+|[A-Za-z]+|\d+(?:\.\d+)?|\*\*|[-+*/^().,=]")
+_POWER_RE = re.compile(r"(?:\^|\*\*)\s*\(?\s*-?(\d+(?:\.\d+)?)\s*\)?\s*(\^|\*\*)?")
+_TRIG_FUNCTIONS = {"sin", "cos", "tan", "cot", "sec", "csc", "asin", "acos", "atan"}
+_UNICODE_OPERATORS = str.maketrans({"×": "*", "·": "*", "÷": "/", "−": "-", "–": "-", "²": "^2", "³": "^3"})
+
+# A trailing "!" is not sentence punctuation here: "What is 5!" asks for a factorial
+_END = r"\s*[?.]?$"
+_WRT = r"(?:\s+(?:with\s+respect\s+to|wrt|w\.r\.t\.?)\s+(?P<wrt>[a-z]))?"
+_DERIVATIVE_RE = re.compile(
+    r"^(?:find\s+|compute\s+|what\s+is\s+)?(?:the\s+)?"
+    r"(?:differentiate|derivative\s+of|d/d(?P<var>[a-z]))\s*:?\s*(?P<expr>.+?)" + _WRT + _END,
+    re.IGNORECASE
+)
+_INTEGRAL_RE = re.compile(
+    r"^(?:find\s+|compute\s+|evaluate\s+|what\s+is\s+)?(?:the\s+)?"
+    r"(?:integrate|integral\s+of|antiderivative\s+of)\s*:?\s*(?P<expr>.+?)(?:\s+d(?P<var>[a-z]))?"
+    r"(?:\s+from\s+(?P<lower>\S+)\s+to\s+(?P<upper>\S+?))?" + _WRT + _END,
+    re.IGNORECASE
+)
+_SOLVE_RE = re.compile(
+    r"^(?:solve(?:\s+for\s+(?P<var>[a-z]))?|find\s+(?P<find>[a-z])\s+(?:if|when|given|such\s+that)|"
+    r"find\s+the\s+roots\s+of)\s*:?\s*(?P<expr>.+?)(?:\s+for\s+(?P<wrt>[a-z]))?" + _END,
+    re.IGNORECASE
+)
+_EVALUATE_RE = re.compile(
+    r"^(?P<verb>evaluate|compute|calculate|simplify|find\s+the\s+value\s+of|what\s+is(?:\s+the\s+value\s+of)?)"
+    r"\s*:?\s*(?P<expr>.+?)" + _END,
+    re.IGNORECASE
+)
+
+# A SymPy call can't be interrupted, so a solve that times out keeps its slot until it
+# finishes; while every slot is taken new questions skip straight to the model
+_slots = threading.BoundedSemaphore(SYMBOLIC_WORKERS)
+
+
+def _ambiguous(expr, bare_log):
+    """Whether the question likely means something the expression doesn't.
+
+    "sin 30" in a JEE question means degrees and SymPy reads radians, so a
+    trig function of a plain number is only trusted when the argument has a
+    pi in it; inverse trig of a number has the same problem with its result.
+    Written as "log", a log of a number may be base 10.
+    """
+    from sympy import log, pi, preorder_traversal
+    from sympy.functions.elementary.trigonometric import InverseTrigonometricFunction, TrigonometricFunction
+
+    for node in preorder_traversal(expr):
+        if isinstance(node, (TrigonometricFunction, InverseTrigonometricFunction)):
+            argument = node.args[0]
+            if not argument.free_symbols and not argument.has(pi):
+                return True
+        if bare_log and isinstance(node, log) and not node.args[0].free_symbols:
+            return True
+    return False
+
+
+def _parse(text, evaluate=True):
+    """Parse a whitelisted expression into SymPy, or return None"""
+    expr = _parse_expr(text, evaluate)
+    if expr is None:
+        return None
+    functions = {token.lower() for token in _TOKEN_RE.findall(text.strip()) if token.isalpha()}
+    if functions & (_TRIG_FUNCTIONS | {"log"}):
+        # Check the expression as written: evaluating folds e.g. log(e) into 1
+        written = expr if not evaluate else _parse_expr(text, evaluate=False)
+        if written is None or _ambiguous(written, "log" in functions):
+            return None
+    return expr
+
+
+def _parse_expr(text, evaluate):
+    import sympy
+    from sympy import Add, E, Float, Integer, Mul, Pow, Rational, Symbol, pi
+    from sympy.parsing.sympy_parser import (
+        convert_xor, implicit_multiplication_application, parse_expr, standard_transformations
+    )
+
+    text = text.strip()
+    if not text or "".join(_TOKEN_RE.findall(text)) != text:
+        return None
+    for token in _TOKEN_RE.findall(text):
+        if token.isalpha() and len(token) > 1 and token.lower() not in _FUNCTIONS:
+            return None
+        if token[0].isdigit() and len(token) > SYMBOLIC_MAX_DIGITS:
+            return None
+    for match in _POWER_RE.finditer(text):
+        if match.group(2) or float(match.group(1)) > SYMBOLIC_MAX_EXPONENT:
+            return None
+
+    # Only these names are visible to parse_expr; the whitelist above keeps out anything else
+    names = {
+        "Integer": Integer, "Float": Float, "Rational": Rational, "Symbol": Symbol,
+        # evaluate=False rewrites operators into these
+        "Add": Add, "Mul": Mul, "Pow": Pow,
+        "__builtins__": {}
+    }
+    names.update({name: getattr(sympy, name) for name in _FUNCTIONS - {"ln", "abs", "pi"}})
+    names.update({"ln": sympy.log, "abs": sympy.Abs, "pi": pi})
+    local_names = {letter: Symbol(letter) for letter in "abcdfghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+    local_names["e"] = E
+    try:
+        return parse_expr(
+            # Function names in any case; single letters keep theirs, so "E" stays a symbol, not e
+            re.sub(r"[A-Za-z]{2,}", lambda match: match.group().lower(), text),
+            local_dict=local_names,
+            global_dict=names,
+            transformations=standard_transformations + (implicit_multiplication_application, convert_xor),
+            evaluate=evaluate
+        )
+    except Exception:
+        return None
+
+
+def _parse_equation(text):
+    """(lhs, rhs) as written, with rhs 0 for a bare expression, or None"""
+    from sympy import Integer
+
+    sides = text.split("=")
+    if len(sides) > 2:
+        return None
+    parsed = [_parse(side, evaluate=False) for side in sides]
+    if any(side is None for side in parsed):
+        return None
+    return (parsed[0], parsed[1]) if len(parsed) == 2 else (parsed[0], Integer(0))
+
+
+def _variable(expr, named):
+    from sympy import Symbol
+
+    if named:
+        return Symbol(named)
+    free = sorted(expr.free_symbols, key=str)
+    return free[0] if len(free) == 1 else None
+
+
+def _is_finite_number(value):
+    from sympy import nan, zoo
+
+    return value.is_number and value.is_finite is not False and not value.has(zoo, nan)
+
+
+def _final_value(value, question_type):
+    """LaTeX for the final answer in the question type's format, or None if it doesn't fit"""
+    from sympy import latex, N
+
+    if not value.is_number:
+        return f"${latex(value)}$"
+    if not _is_finite_number(value) or value.is_real is not True:
+        # "i" is parsed as a symbol, so complex answers would contradict how the question was read
+        return None
+    if question_type == "Integer Type":
+        return f"${latex(value)}$" if value.is_integer else None
+    if question_type == "Numerical Value":
+        numeric = N(value)
+        if numeric.is_real is False:
+            return None
+        return f"${float(numeric):.2f}$"
+    if value.is_rational:
+        return f"${latex(value)}$"
+    return f"${latex(value)} \\approx {float(N(value)):.4g}$"
+
+
+def _evaluate(expression_text, question_type, require_number):
+    from sympy import latex, nsimplify, simplify
+
+    expr = _parse(expression_text, evaluate=False)
+    if expr is None or (require_number and expr.free_symbols):
+        return None
+    value = simplify(expr.doit())
+    if value.free_symbols and (expr.is_Symbol or value == expr):
+        # "What is g" or "simplify m/s" asks about a quantity, not an expression
+        return None
+    if value.is_number and value.is_Float:
+        value = nsimplify(value, rational=True)
+    final = _final_value(value, question_type)
+    if final is None:
+        return None
+    action = "Evaluate" if value.is_number else "Simplify"
+    return (
+        f"{action} the expression $${latex(expr, order='none')}$$",
+        [
+            f"Write the expression as $${latex(expr, order='none')}$$",
+            f"Simplifying gives $${latex(value)}$$"
+        ],
+        final
+    )
+
+
+def _solve(equation_text, variable_name, question_type):
+    from sympy import Eq, Mul, factor, latex, solve
+    from sympy.functions.elementary.trigonometric import TrigonometricFunction
+    from sympy.polys.rootoftools import ComplexRootOf
+
+    sides = _parse_equation(equation_text)
+    if sides is None:
+        return None
+    equation = Eq(*sides, evaluate=False)
+    expr = (sides[0] - sides[1]).doit()
+    variable = _variable(expr, variable_name)
+    if variable is None or variable not in expr.free_symbols:
+        return None
+    if expr.free_symbols - {variable}:
+        return None
+    if any(variable in node.free_symbols for node in expr.atoms(TrigonometricFunction)):
+        # solve() gives one period's roots of a periodic equation, not the general solution
+        return None
+    solutions = solve(expr, variable)
+    if not solutions or not all(_is_finite_number(solution) for solution in solutions):
+        return None
+    if any(solution.has(ComplexRootOf) or solution.is_real is None for solution in solutions):
+        # No closed form, or SymPy can't tell whether a root is real; the model can say more
+        return None
+    # "i" is parsed as a symbol, so the question is read over the reals
+    real_only = not all(solution.is_real for solution in solutions)
+    solutions = [solution for solution in solutions if solution.is_real]
+    if not solutions:
+        return None
+    finals = [_final_value(solution, question_type) for solution in solutions]
+    if question_type in ("Integer Type", "Numerical Value"):
+        # A single numeric answer is expected; several roots means the question has more to it
+        if len(solutions) != 1 or finals[0] is None:
+            return None
+    if any(final is None for final in finals):
+        return None
+
+    var = latex(variable)
+    steps = [f"Bring every term to one side: $${latex(Eq(expr.expand(), 0))}$$"]
+    factored = factor(expr)
+    if len([f for f in Mul.make_args(factored) if f.free_symbols]) > 1:
+        steps.append(f"Factorise: $${latex(Eq(factored, 0))}$$")
+    over = " over the reals" if real_only else ""
+    steps.append(f"Solving for ${var}${over} gives $${', '.join(f'{var} = {latex(s)}' for s in solutions)}$$")
+    answer = " or ".join(f"${var} = {final.strip('$')}$" for final in finals)
+    return (f"Solve $${latex(equation)}$$ for ${var}$.", steps, answer)
+
+
+def _derivative(expression_text, variable_name):
+    from sympy import Derivative, diff, latex, simplify
+
+    expr = _parse(expression_text)
+    if expr is None:
+        return None
+    variable = _variable(expr, variable_name)
+    if variable is None:
+        return None
+    result = simplify(diff(expr, variable))
+    if result.has(Derivative):
+        return None
+    var = latex(variable)
+    return (
+        f"Differentiate $${latex(expr)}$$ with respect to ${var}$.",
+        [
+            f"Apply the standard differentiation rules term by term: $$\\frac{{d}}{{d{var}}}\\left({latex(expr)}\\right)$$",
+            f"Simplifying gives $${latex(result)}$$"
+        ],
+        f"$\\frac{{d}}{{d{var}}}\\left({latex(expr)}\\right) = {latex(result)}$"
+    )
+
+
+def _integral(expression_text, variable_name, lower_text, upper_text, question_type):
+    from sympy import Integral, integrate, latex, log, simplify
+
+    expr = _parse(expression_text)
+    if expr is None:
+        return None
+    variable = _variable(expr, variable_name)
+    if variable is None:
+        return None
+    antiderivative = simplify(integrate(expr, variable))
+    if antiderivative.has(Integral):
+        return None
+    var = latex(variable)
+    steps = [f"An antiderivative is $$F({var}) = {latex(antiderivative)}$$"]
+
+    if lower_text is None:
+        if antiderivative.has(log):
+            # SymPy drops the absolute value in ln|x|; leave those to the model
+            return None
+        return (
+            f"Find $$\\int {latex(expr)} \\, d{var}$$",
+            steps,
+            f"${latex(antiderivative)} + C$"
+        )
+
+    lower, upper = _parse(lower_text), _parse(upper_text)
+    if lower is None or upper is None or lower.free_symbols or upper.free_symbols:
+        return None
+    value = simplify(antiderivative.subs(variable, upper) - antiderivative.subs(variable, lower))
+    final = _final_value(value, question_type)
+    if final is None:
+        return None
+    steps.append(f"Apply the limits: $$F({latex(upper)}) - F({latex(lower)}) = {latex(value)}$$")
+    return (
+        f"Evaluate $$\\int_{{{latex(lower)}}}^{{{latex(upper)}}} {latex(expr)} \\, d{var}$$",
+        steps,
+        final
+    )
+
+
+def _route(text, question_type):
+    """Pick the question's form and solve it; (analysis, steps, final answer) or None"""
+    match = _DERIVATIVE_RE.match(text)
+    if match:
+        return _derivative(match.group("expr"), match.group("var") or match.group("wrt"))
+    match = _INTEGRAL_RE.match(text)
+    if match:
+        return _integral(
+            match.group("expr"), match.group("var") or match.group("wrt"),
+            match.group("lower"), match.group("upper"), question_type
+        )
+    match = _SOLVE_RE.match(text)
+    if match:
+        return _solve(match.group("expr"), match.group("var") or match.group("find") or match.group("wrt"), question_type)
+    match = _EVALUATE_RE.match(text)
+    if match:
+        simplify_asked = match.group("verb").lower() == "simplify"
+        return _evaluate(match.group("expr"), question_type, require_number=not simplify_asked)
+    if "=" in text:
+        return _solve(text, None, question_type)
+    # A bare expression must at least look like arithmetic, not just a number
+    if re.search(r"\d", text) and re.search(r"[-+*/^]", text.lstrip("-+")):
+        return _evaluate(text, question_type, require_number=True)
+    return None
+
+
+def format_solution(analysis, steps, final_answer):
+    """Same layout update_system_message asks the model for"""
+    numbered = "\n".join(f"{i}. {step}" for i, step in enumerate(steps, 1))
+    return (
+        f"**Question Analysis:** {analysis}\n\n"
+        f"**Solution Steps:**\n{numbered}\n\n"
+        f"**Final Answer:** {final_answer}"
+    )
+
+
+def _run_in_slot(future, text, question_type):
+    try:
+        future.set_result(_route(text, question_type))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        _slots.release()
+
+
+def solve_symbolically(text, question_type=None):
+    """A formatted solution for a pure-math question, or None to use the model"""
+    text = " ".join((text or "").translate(_UNICODE_OPERATORS).split())
+    if not text or len(text) > SYMBOLIC_MAX_LENGTH:
+        return None
+    if not _slots.acquire(blocking=False):
+        print(f"Symbolic solver busy with {SYMBOLIC_WORKERS} solve(s); leaving {text!r} to the model")
+        return None
+    future = Future()
+    # Daemon, so a runaway solve never holds up the process exiting
+    threading.Thread(
+        target=_run_in_slot, args=(future, text, question_type), name="symbolic", daemon=True
+    ).start()
+    try:
+        solved = future.result(timeout=SYMBOLIC_TIMEOUT)
+    except FutureTimeout:
+        print(f"Symbolic solve timed out after {SYMBOLIC_TIMEOUT}s: {text!r}")
+        return None
+    except Exception as e:
+        print(f"Symbolic solve failed for {text!r}: {e}")
+        return None
+    return format_solution(*solved) if solved else None
+
+
+def symbolic_response(text, question_type=None):
+    """get_response-shaped result from the local engine, or None on a miss.
+
+    Hits and misses are recorded as symbolic.hit / symbolic.miss so the
+    admin page can show the hit rate and the model latency saved.
+    """
+    if not SYMBOLIC_FAST_PATH:
+        return None
+    start = time.perf_counter()
+    content = solve_symbolically(text, question_type)
+    duration_ms = (time.perf_counter() - start) * 1000
+    record("symbolic.hit" if content else "symbolic.miss", duration_ms)
+    if not content:
+        return None
+    return {
+        "content": content,
+        "token_usage": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "model": "sympy",
+            "symbolic": True
+        }
+    }
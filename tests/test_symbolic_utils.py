@@ -0,0 +1,49 @@
+# tests/test_symbolic_utils.py
+"""Final answers from the symbolic fast path: what it may answer, and what it must leave to the model."""
+import pytest
+
+from symbolic_utils import solve_symbolically
+
+
+def final_answer(text, question_type=None):
+    solution = solve_symbolically(text, question_type)
+    return solution.split("**Final Answer:**")[1].strip() if solution else None
+
+
+@pytest.mark.parametrize("text, question_type, expected", [
+    ("2 + 3 * 4", None, "$14$"),
+    ("Solve x^2 - 5x + 6 = 0", None, "$x = 2$ or $x = 3$"),
+    ("Evaluate sin(pi/6)", None, "$\\frac{1}{2}$"),
+    ("What is ln e", None, "$1$"),
+    ("Integrate cos x from 0 to pi/2", "Numerical Value", "$1.00$"),
+    ("Simplify (x^2-1)/(x-1)", None, "$x + 1$"),
+    ("Solve x^3 = 8", None, "$x = 2$"),
+])
+def test_answers(text, question_type, expected):
+    assert final_answer(text, question_type) == expected
+
+
+@pytest.mark.parametrize("text, question_type", [
+    # A factorial, not an exclamation
+    ("What is 5!", None),
+    # Degrees in the question, radians in SymPy
+    ("Evaluate sin 30", "Numerical Value"),
+    ("Evaluate cos 60", "Numerical Value"),
+    ("Evaluate asin 0.5", None),
+    # log may mean base 10
+    ("What is log 100?", None),
+    ("Evaluate log(e)", None),
+    # A quantity or a unit, not an expression
+    ("What is E?", None),
+    ("What is g", None),
+    ("What is m/s", None),
+    # One period's roots, not the general solution
+    ("Solve sin x = 0", None),
+    # No closed form
+    ("Solve x^5 - x + 1 = 0", None),
+    # "i" is read as a symbol, so nothing may come out complex
+    ("What is e^(i pi)", None),
+    ("Solve x^2 + 1 = 0", None),
+])
+def test_declines_ambiguous_questions(text, question_type):
+    assert solve_symbolically(text, question_type) is None